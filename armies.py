@@ -0,0 +1,239 @@
+"""
+Searches for strong armies within the 200 point budget by self-play:
+
+    python3 armies.py --generations 10 --population 16 --workers 8
+
+Armies are scored by short headless games of builtin_ai2, played both ways
+against a pool of opponents. Every game played is appended to the cache
+file, so that no matchup is ever played twice, even across runs. The best
+army found is printed as a setup function.
+"""
+
+import json
+import os
+import random
+from argparse import ArgumentParser
+from dataclasses import astuple
+from multiprocessing import Pool
+from time import time
+from buildaboard import Range, PieceType, Piece, attackPrices, movementPrices, king
+from game import play, verify_setup
+import builtin_ai2
+import builtin_ai3
+
+budget = 200
+# Ranges go no further than this on an 8x8 board.
+longest = 7
+
+# A type is its 16 ranges, attack then movement, in the order of Range's
+# fields; an army is its king's square and a sorted tuple of (type, square)
+# pairs. Both stay plain tuples until a game is played with them.
+weights = astuple(attackPrices) + astuple(movementPrices)
+prices = {}
+
+def typePrice(ranges) -> int:
+    if ranges not in prices: prices[ranges] = 10 + sum(r * w for r, w in zip(ranges, weights))
+    return prices[ranges]
+
+def armyPrice(army) -> int: return sum(typePrice(ranges) for ranges, _ in army[1])
+
+def dominates(a, b) -> bool:
+    # a is at least as good as b in every direction once ranges are cut
+    # down to what the board allows, and costs no more.
+    return a != b and typePrice(a) <= typePrice(b) and \
+        all(min(x, longest) >= min(y, longest) for x, y in zip(a, b))
+
+def prune(types):
+    return [b for b in types if typePrice(b) <= budget and not any(dominates(a, b) for a in types)]
+
+def armyKey(army) -> str:
+    # Mirror images get keys of their own: they only play alike against
+    # mirrored opponents, and the built-in setups are not symmetric.
+    king_square, pieces = army
+    return ' '.join([f'K@{king_square}'] + sorted(
+        ''.join(map(str, ranges)) + f'@{square}' for ranges, square in pieces))
+
+def parseArmy(key: str):
+    king_square, pieces = None, []
+    for piece in key.split():
+        ranges, square = piece.split('@')
+        if ranges == 'K': king_square = int(square)
+        else: pieces.append((tuple(map(int, ranges)), int(square)))
+    return king_square, tuple(sorted(pieces))
+
+def armyPieces(army):
+    king_square, pieces = army
+    return [Piece(PieceType(Range(*ranges[:8]), Range(*ranges[8:])), square >> 3, square & 7)
+            for ranges, square in pieces] + [Piece(king, king_square >> 3, king_square & 7)]
+
+def fromSetup(pieces):
+    king_square = next(p.rank * 8 + p.file for p in pieces if p.type == king)
+    return king_square, tuple(sorted((astuple(p.type.attack) + astuple(p.type.movement), p.rank * 8 + p.file)
+                                     for p in pieces if p.type != king))
+
+
+def randomType(rng):
+    # Mostly short ranges, in a few directions.
+    return tuple(rng.choice((0, 0, 0, 1, 1, 2, 3, longest)) for _ in range(16))
+
+def fill(army, types, rng):
+    # Adds pieces of the given types on free squares while the budget allows.
+    king_square, pieces = army
+    pieces = list(pieces)
+    free = [s for s in range(24) if s != king_square and all(s != square for _, square in pieces)]
+    rng.shuffle(free)
+    spent = sum(typePrice(ranges) for ranges, _ in pieces)
+    for square in free:
+        affordable = [t for t in types if spent + typePrice(t) <= budget]
+        if not affordable: break
+        ranges = rng.choice(affordable)
+        pieces.append((ranges, square))
+        spent += typePrice(ranges)
+    return king_square, tuple(sorted(pieces))
+
+def randomArmy(rng):
+    types = prune([randomType(rng) for _ in range(rng.randint(1, 3))])
+    return fill((rng.randrange(8), ()), types or [randomType(rng)], rng)
+
+def mutate(army, rng):
+    king_square, pieces = army
+    pieces = list(pieces)
+    types = list(dict.fromkeys(ranges for ranges, _ in pieces))
+    kind = rng.randrange(4)
+    if kind == 0 and types:
+        # One range of one type, for every piece of it.
+        old = rng.choice(types)
+        new = list(old)
+        i = rng.randrange(16)
+        new[i] = max(0, min(longest, new[i] + rng.choice((-1, 1))))
+        pieces = [(tuple(new) if ranges == old else ranges, square) for ranges, square in pieces]
+    elif kind == 1 and pieces:
+        # One piece somewhere else, or the king.
+        taken = {king_square} | {square for _, square in pieces}
+        square = rng.choice([s for s in range(24) if s not in taken] or [king_square])
+        if rng.random() < .2: king_square = square
+        else:
+            i = rng.randrange(len(pieces))
+            pieces[i] = (pieces[i][0], square)
+    elif kind == 2 and pieces:
+        pieces.pop(rng.randrange(len(pieces)))
+    else: types.append(randomType(rng))
+    while sum(typePrice(ranges) for ranges, _ in pieces) > budget:
+        pieces.pop(rng.randrange(len(pieces)))
+    return fill((king_square, tuple(sorted(pieces))), prune(types) or types, rng)
+
+
+class ArmyPlayer:
+    # Plays a fixed army with builtin_ai2.
+
+    def __init__(self, key: str): self.army = parseArmy(key)
+    def setup(self): return armyPieces(self.army)
+    def move(self, board, clock): return builtin_ai2.move(board, clock)
+
+def playGame(task):
+    # Games are searched to a fixed depth on a clock that never runs out,
+    # so that their result only depends on the armies.
+    white, black, depth, max_plys = task
+    builtin_ai2.max_depth = depth
+    builtin_ai2.table.clear()
+    game = play(ArmyPlayer(white), ArmyPlayer(black), 10 ** 6, 0, max_plys)
+    return task, {True: 'white', False: 'black', None: None}[game.winner]
+
+class Results:
+    # Every game ever played, by white, black, depth and ply limit, kept in
+    # a JSON lines file.
+
+    def __init__(self, path: str):
+        self.games = {}
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    game = json.loads(line)
+                    self.games[game['white'], game['black'], game['depth'], game['plys']] = game['winner']
+        self.file = open(path, 'a')
+        self.played = self.hits = 0
+
+    def play(self, tasks, pool):
+        missing = list(dict.fromkeys(task for task in tasks if task not in self.games))
+        self.hits += len(tasks) - len(missing)
+        for (white, black, depth, plys), winner in pool.imap_unordered(playGame, missing):
+            self.games[white, black, depth, plys] = winner
+            self.file.write(json.dumps({'white': white, 'black': black, 'depth': depth,
+                                        'plys': plys, 'winner': winner}) + '\n')
+            self.file.flush()
+            self.played += 1
+        return [self.games[task] for task in tasks]
+
+def score(candidates, opponents, results, pool, depth, max_plys):
+    # The share of points each candidate takes off the opponents, playing
+    # each of them once with either colour.
+    tasks = [task for army in candidates for opponent in opponents
+             for task in ((army, opponent, depth, max_plys), (opponent, army, depth, max_plys))]
+    winners = iter(results.play(tasks, pool))
+    scores = {}
+    for army in candidates:
+        points = 0
+        for _ in opponents:
+            points += {'white': 1, 'black': 0, None: .5}[next(winners)]
+            points += {'white': 0, 'black': 1, None: .5}[next(winners)]
+        scores[army] = points / (2 * len(opponents))
+    return scores
+
+def search(generations, population, workers, cache, depth=2, max_plys=150, seed=0):
+    rng = random.Random(seed)
+    builtins = [builtin_ai2.mixed_setup(), builtin_ai2.pawn_setup(), builtin_ai3.setup()]
+    opponents = [armyKey(fromSetup(setup)) for setup in builtins]
+    results = Results(cache)
+    start, evaluated = time(), 0
+    scores = {}
+    with Pool(workers) as pool:
+        armies = [fromSetup(setup) for setup in builtins]
+        armies += [randomArmy(rng) for _ in range(population - len(armies))]
+        for generation in range(generations):
+            candidates = []
+            for army in armies:
+                if verify_setup(armyPieces(army)) is None and armyKey(army) not in scores:
+                    candidates.append(armyKey(army))
+            candidates = list(dict.fromkeys(candidates))
+            scores.update(score(candidates, opponents, results, pool, depth, max_plys))
+            evaluated += len(candidates)
+            best = sorted(scores, key=scores.get, reverse=True)[:max(population // 4, 1)]
+            elapsed = time() - start
+            yield {'generation': generation, 'best': best[0], 'score': scores[best[0]],
+                   'evaluated': evaluated, 'games': results.played, 'cached': results.hits,
+                   'armies_per_hour': evaluated / elapsed * 3600 if elapsed else 0}
+            # The best ones go on, along with mutations of them and a few
+            # new random armies.
+            parents = [parseArmy(key) for key in best]
+            armies = parents + [mutate(rng.choice(parents), rng) for _ in range(population - len(parents) - 2)]
+            armies += [randomArmy(rng) for _ in range(2)]
+
+def setupCode(key: str) -> str:
+    army = parseArmy(key)
+    types = list(dict.fromkeys(ranges for ranges, _ in army[1]))
+    lines = ['def setup():', '']
+    for i, ranges in enumerate(types):
+        lines += [f'    type{i} = PieceType(', f'        Range{ranges[:8]},', f'        Range{ranges[8:]}', '        )']
+    lines += ['', '    return [' + ',\n            '.join(
+        [f'Piece(type{types.index(ranges)}, {square >> 3}, {square & 7})' for ranges, square in army[1]] +
+        [f'Piece(king, {army[0] >> 3}, {army[0] & 7})']) + '\n            ]']
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Searches for strong armies by self-play.')
+    parser.add_argument('--generations', type=int, default=10)
+    parser.add_argument('--population', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--depth', type=int, default=2, help='search depth of the games')
+    parser.add_argument('--plys', type=int, default=150, help='plies before a game is a draw')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', default='armies.jsonl', help='file every game played is kept in')
+    args = parser.parse_args()
+    report = None
+    for report in search(args.generations, args.population, args.workers, args.cache,
+                         args.depth, args.plys, args.seed):
+        print(f"generation {report['generation']}: best {report['score']:.2f}, "
+              f"{report['evaluated']} armies, {report['games']} games played, {report['cached']} cached, "
+              f"{report['armies_per_hour']:.0f} armies/hour")
+    if report: print(setupCode(report['best']))
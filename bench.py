@@ -0,0 +1,144 @@
+"""
+Benchmarks move generation and search on fixed positions:
+
+    python3 bench.py --output bench.json
+
+Perft counts are checked against the reference Board generator, so the
+suite also fails loudly when a faster generator disagrees with it. Also
+times starting a game of builtin_ai2 against itself in a new interpreter,
+with nothing cached yet and then with its compiled code on disk.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from timeit import Timer
+from time import time
+from buildaboard import Piece, Board, BitBoard, king, queen
+from engine import TimeManager
+import builtin_ai2
+import builtin_ai3
+
+def positions():
+    mixed, pawns = builtin_ai2.mixed_setup(), builtin_ai2.pawn_setup()
+    queens = [Piece(queen, 2, 1), Piece(queen, 2, 6), Piece(queen, 3, 3), Piece(king, 0, 4)]
+    return {
+        'mixed-vs-pawns': Board([p.flipped for p in pawns], mixed, False),
+        'pawns-vs-mixed': Board([p.flipped for p in mixed], pawns, False),
+        'queens': Board([p.flipped for p in queens], builtin_ai2.pawn_setup()[:4] + queens, True),
+    }
+
+# Reference counts from the original Board generator, by depth.
+expected_perft = {
+    'mixed-vs-pawns': [1, 10, 139, 1431, 18464, 195560],
+    'pawns-vs-mixed': [1, 14, 140, 1830, 18833, 233936],
+    'queens': [1, 47, 2752, 136438],
+}
+
+def perft(board, depth):
+    if depth == 0: return 1
+    if not any(p.type == king for p in board.to_move): return 0
+    nodes = 0
+    for piece in list(board.to_move):
+        for rank, file in board.generateAllowed(piece):
+            undo = board.make_move((piece, rank, file))
+            nodes += perft(board, depth - 1)
+            board.unmake_move(undo)
+    return nodes
+
+def rate(function, number):
+    # Calls per second, best of three runs.
+    return number / min(Timer(function).repeat(3, number))
+
+def bench_perft(board, name, depth):
+    results = {}
+    for kind in (Board, BitBoard):
+        start = time()
+        nodes = [perft(board.copy(kind), d) for d in range(depth + 1)]
+        elapsed = time() - start
+        expected = expected_perft[name][:depth + 1]
+        assert nodes[:len(expected)] == expected, f'{kind.__name__} perft mismatch on {name}: {nodes}'
+        results[kind.__name__] = {'nodes': nodes, 'time': elapsed, 'nps': sum(nodes) / elapsed}
+    return results
+
+def bench_functions(board):
+    results = {}
+    for kind in (Board, BitBoard):
+        b = board.copy(kind)
+        moves = [(p, r, f) for p in b.to_move for r, f in b.generateAllowed(p)]
+        def make_unmake():
+            for move in moves: b.unmake_move(b.make_move(move))
+        results[kind.__name__] = {
+            'generateAllowed': rate(lambda: [b.generateAllowed(p) for p in b.to_move], 200) * len(b.to_move),
+            'all_valid_moves': rate(lambda: b.all_valid_moves, 100),
+            'make_unmake': rate(make_unmake, 100) * len(moves),
+        }
+    b = board.copy(BitBoard)
+    results['eval_b'] = {'builtin_ai2': rate(lambda: builtin_ai2.eval_b(b), 500),
+                         'builtin_ai3': rate(lambda: builtin_ai3.eval_b(b), 500)}
+    return results
+
+def bench_search(board, seconds):
+    builtin_ai2.table.clear()
+    start = time()
+    builtin_ai2.choosemove(board.copy(BitBoard), seconds)
+    results = {'builtin_ai2': dict(builtin_ai2.stats, elapsed=time() - start)}
+    start = time()
+    builtin_ai3.choosemove(board.copy(BitBoard), TimeManager(seconds, seconds))
+    results['builtin_ai3'] = dict(builtin_ai3.stats, elapsed=time() - start)
+    return results
+
+# Run in a new interpreter: imports the host, then starts two games the way
+# newGame does, the second one with the compiled code in memory. The first
+# one also loads the sandbox.
+startupScript = """
+import json, sys
+from time import perf_counter
+start = perf_counter()
+import main
+imported = perf_counter()
+games = []
+for _ in range(2):
+    begin = perf_counter()
+    import sandbox
+    sandbox.cache_directory = sys.argv[1]
+    players = [main.Player.fromText('Builtin AI', None) for _ in range(2)]
+    for player in players: player.setup()
+    games.append(perf_counter() - begin)
+    for player in players: player.close()
+print(json.dumps({'import': imported - start, 'first_game': games[0], 'next_game': games[1]}))
+"""
+
+def bench_startup():
+    results = {}
+    with tempfile.TemporaryDirectory() as cache:
+        for name in ('cold', 'warm'):
+            start = time()
+            output = subprocess.run([sys.executable, '-c', startupScript, cache],
+                                    capture_output=True, text=True, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            results[name] = dict(json.loads(output), total=time() - start)
+    return results
+
+def run(perft_depth=3, search_time=2.0):
+    report = {'perft': {}, 'functions': {}, 'search': {}, 'startup': bench_startup()}
+    for name, board in positions().items():
+        report['perft'][name] = bench_perft(board, name, min(perft_depth, len(expected_perft[name]) - 1))
+        report['functions'][name] = bench_functions(board)
+        # Searches only make sense from the side to move's point of view.
+        report['search'][name] = bench_search(board if board.player_turn else board.flipped, search_time)
+    return report
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks move generation and search.')
+    parser.add_argument('--perft-depth', type=int, default=3)
+    parser.add_argument('--search-time', type=float, default=2.0)
+    parser.add_argument('--output', help='JSON file to write the results to')
+    args = parser.parse_args()
+    report = run(args.perft_depth, args.search_time)
+    if args.output:
+        with open(args.output, 'w') as output: json.dump(report, output, indent=2)
+    print(json.dumps(report, indent=2))
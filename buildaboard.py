@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from random import Random
 from typing import Optional
 
 @dataclass(frozen=True, eq=True)
@@ -22,19 +23,40 @@ def dotProduct(a: Range, b: Range) -> int:
     return sum(getattr(a, property) * getattr(b, property)
         for property in ('n', 'nw', 'ne', 'e', 'w', 's', 'sw', 'se'))
 
-@dataclass(frozen=True, eq=True)
+directions = ('n', 'nw', 'ne', 'w', 'e', 'sw', 's', 'se')
+
+# Piece types are interned: building a type that already exists returns the
+# existing object. Each one gets a small integer id into pieceTypes, and its
+# price, flipped type and per-direction limits (in the order of directions)
+# are computed once instead of on every read.
+pieceTypes = []
+pieceTypeIds = {}
+
+@dataclass(frozen=True, eq=False)
 class PieceType:
     attack: Range
     movement: Range
 
-    @property
-    def flipped(self):
-        return PieceType(self.attack.flipped, self.movement.flipped)
+    def __new__(cls, attack: Range, movement: Range):
+        if (attack, movement) in pieceTypeIds:
+            return pieceTypes[pieceTypeIds[attack, movement]]
+        self = super().__new__(cls)
+        define = lambda name, value: object.__setattr__(self, name, value)
+        define('attack', attack)
+        define('movement', movement)
+        define('id', len(pieceTypes))
+        define('price', 10 + dotProduct(attackPrices, attack) +
+               dotProduct(movementPrices, movement))
+        define('attack_limits', tuple(getattr(attack, prop) for prop in directions))
+        define('movement_limits', tuple(getattr(movement, prop) for prop in directions))
+        pieceTypeIds[attack, movement] = self.id
+        pieceTypes.append(self)
+        define('flipped', cls(attack.flipped, movement.flipped))
+        return self
 
-    @property
-    def price(self):
-        return 10 + dotProduct(attackPrices, self.attack) + \
-            dotProduct(movementPrices, self.movement)
+    def __reduce__(self): return PieceType, (self.attack, self.movement)
+    def __copy__(self): return self
+    def __deepcopy__(self, memo): return self
 
 queen = PieceType(
     Range(8, 8, 8, 8, 8, 8, 8, 8),
@@ -46,7 +68,7 @@ king = PieceType(
     Range(1, 1, 1, 1, 1, 1, 1, 1)
     )
 
-@dataclass
+@dataclass(slots=True)
 class Piece:
     type: PieceType
     rank: int
@@ -59,12 +81,33 @@ class Piece:
     def flipped(self):
         return Piece(self.type.flipped, 7-self.rank, self.file)
 
+    @property
+    def frozen(self): return FrozenPiece(self.type, self.rank, self.file)
+
+@dataclass(frozen=True, slots=True, eq=False)
+class FrozenPiece:
+    type: PieceType
+    rank: int
+    file: int
+
+    @property
+    def flipped(self):
+        return FrozenPiece(self.type.flipped, 7-self.rank, self.file)
+
+    @property
+    def frozen(self): return self
+
+    def __copy__(self): return self
+    def __deepcopy__(self, memo): return self
+
 @dataclass
 class Move:
     piece: Piece
     rank: int
     file: int
 
+    def __iter__(self): return iter((self.piece, self.rank, self.file))
+
     @property
     def flipped(self):
         return Move(self.piece.flipped, 7 - self.rank, self.file)
@@ -85,46 +128,365 @@ class Board:
     opponent: list[Piece]
     player: list[Piece]
     player_turn: bool = False
+    # Moves of the piece on a square, whichever side is to move, along
+    # with the squares that can change them; see legal_moves.
+    legal: dict = field(default_factory=dict, init=False, repr=False, compare=False)
 
     @property
     def pieces(self): return self.opponent + self.player
 
+    @property
+    def to_move(self): return self.player if self.player_turn else self.opponent
+
     @property
     def all_valid_moves(self): return {
         files[piece.file] + ranks[piece.rank]: [files[file] + ranks[rank]
-            for rank, file in self.generateAllowed(piece)]
+            for rank, file in (self.legal_moves(piece) if (piece in self.player) == self.player_turn else [])]
         for piece in self.pieces
     }
 
     @property
-    def flipped(self): return Board(
+    def flipped(self): return type(self)(
             [p.flipped for p in self.player],
             [p.flipped for p in self.opponent],
             player_turn = not self.player_turn
         )
 
+    def snapshot(self): return BoardSnapshot(self.opponent, self.player, self.player_turn)
+
+    def copy(self, kind=None):
+        # A board of the given kind that can be played on, with pieces of
+        # its own.
+        return (kind or Board)([Piece(p.type, p.rank, p.file) for p in self.opponent],
+                               [Piece(p.type, p.rank, p.file) for p in self.player],
+                               self.player_turn)
+
     def generateAllowed(board, piece):
+        if board.player_turn != (piece in board.player): return []
+        return board.targets(piece, board.player_turn)
+
+    def targets(board, piece, player):
+        # Where the piece could go if its side, the player's or the
+        # opponent's, were to move.
         allowed = []
-        for prop in ('n', 'nw', 'ne', 'w', 'e', 'sw', 's', 'se'):
-            if board.player_turn != (piece in board.player): continue
-            opponents = board.opponent if board.player_turn else board.player
+        type = piece.type
+        opponents = board.opponent if player else board.player
+        for k, prop in enumerate(directions):
             for i in range(1, 9):
                 target_rank = piece.rank + dirToCoordDelta[prop][1] * i
                 target_file = piece.file + dirToCoordDelta[prop][0] * i
                 if not withinBoard(target_rank, target_file): break
-                if (i <= getattr(piece.type.movement, prop) and
+                if (i <= type.movement_limits[k] and
                     not pieceAt(board.pieces, target_rank, target_file)) or (
-                    i <= getattr(piece.type.attack, prop) and
+                    i <= type.attack_limits[k] and
                     pieceAt(opponents, target_rank, target_file)):
                     allowed.append((target_rank, target_file))
                 if pieceAt(board.pieces, target_rank, target_file): break
         return allowed
 
+    # Moves of the side to move split in two: tactical ones, captures,
+    # which only attack ranges allow, and moves onto the promotion rank by
+    # pieces that promote there; and quiet ones, everything else.
+    def captures(board, piece):
+        others = board.opponent if board.player_turn else board.player
+        return [(rank, file) for rank, file in board.generateAllowed(piece)
+                if pieceAt(others, rank, file) or promotes(piece, rank, board.player_turn)]
+
+    def quiets(board, piece):
+        others = board.opponent if board.player_turn else board.player
+        return [(rank, file) for rank, file in board.generateAllowed(piece)
+                if not pieceAt(others, rank, file) and not promotes(piece, rank, board.player_turn)]
+
+    def legal_moves(self, piece):
+        # targets of a piece on the board, cached by square until a move
+        # goes through a square within its reach.
+        square = piece.rank * 8 + piece.file
+        if square not in self.legal:
+            self.legal[square] = (reach(piece.type)[square],
+                                  self.targets(piece, piece in self.player))
+        return self.legal[square][1]
+
+    def forget(self, source, target):
+        changed = 1 << source | 1 << target
+        for square in [s for s, (mask, _) in self.legal.items() if mask & changed]:
+            del self.legal[square]
+
     def check_move(self, m: Move) -> bool:
         if not withinBoard(m.rank, m.file): return
-        source = files[m.piece.file] + ranks[m.piece.rank]
-        target = files[m.file] + ranks[m.rank]
-        return target in self.all_valid_moves[source]
+        for piece in self.to_move:
+            if piece.rank == m.piece.rank and piece.file == m.piece.file:
+                return (m.rank, m.file) in self.legal_moves(piece)
+        return False
+
+    # Moves are played in place from the point of view of the side to move,
+    # so a search never needs to flip or copy the board: make_move returns
+    # everything unmake_move needs to restore the previous position.
+    def make_move(self, move):
+        piece, rank, file = move
+        others = self.opponent if self.player_turn else self.player
+        index = self.capture_index(others, rank, file)
+        captured = others.pop(index) if index is not None else None
+        undo = (piece, piece.rank, piece.file, piece.type, captured, index)
+        if self.legal: self.forget(piece.rank * 8 + piece.file, rank * 8 + file)
+        piece.rank, piece.file = rank, file
+        if piece.type != king and rank == (7 if self.player_turn else 0):
+            piece.type = queen
+        self.player_turn = not self.player_turn
+        return undo
+
+    def unmake_move(self, undo):
+        piece, rank, file, type, captured, index = undo
+        if self.legal: self.forget(rank * 8 + file, piece.rank * 8 + piece.file)
+        self.player_turn = not self.player_turn
+        piece.rank, piece.file, piece.type = rank, file, type
+        if captured is not None:
+            (self.opponent if self.player_turn else self.player).insert(index, captured)
+
+    def capture_index(self, pieces, rank, file):
+        for index, piece in enumerate(pieces):
+            if piece.rank == rank and piece.file == file: return index
+
+    def evaluate(self, king_value, perspective=True):
+        # Material and advancement, seen from the player's side if
+        # perspective is set and from the opponent's side otherwise.
+        total = 0
+        for player in (False, True):
+            for piece in (self.player if player else self.opponent):
+                own, other = pieceTerms(piece, player)
+                if piece.type == king: own, other = own + king_value, other - king_value
+                total += own if player == perspective else other
+        return total
+
+def promotes(piece, rank, player):
+    # Whether moving the piece to the rank turns it into a queen.
+    return piece.type != king and piece.type != queen and rank == (7 if player else 0)
+
+def pieceTerms(piece, player):
+    # What a piece adds to the evaluation of its own side and of the other
+    # side, leaving the king value out. Ranks and prices are taken from the
+    # point of view of the piece's owner.
+    type = piece.type if player else piece.type.flipped
+    rank = piece.rank if player else 7 - piece.rank
+    if type == king: return -rank, 7 - rank
+    return type.price + rank, -type.price - rank
+
+
+# Squares are numbered rank * 8 + file, so that every direction is a fixed
+# step on a 64-bit mask: north is +8, east is +1, and so on.
+dirToSquareDelta = {'n': 8, 'nw': 7, 'ne': 9, 'e': 1,
+                    'w': -1, 's': -8, 'sw': -9, 'se': -7}
+
+# Indexed by piece type id.
+rayTables = []
+
+def rays(type: PieceType):
+    while len(rayTables) <= type.id: rayTables.append(None)
+    if rayTables[type.id] is None:
+        rayTables[type.id] = [tuple(ray for k in range(len(directions))
+                                    if (ray := buildRay(type, rank, file, k)))
+                              for rank in range(8) for file in range(8)]
+    return rayTables[type.id]
+
+# Every square some ray of a piece type crosses from a square, and that
+# square itself, indexed by piece type id.
+reachTables = []
+
+def reach(type: PieceType):
+    while len(reachTables) <= type.id: reachTables.append(None)
+    if reachTables[type.id] is None:
+        reachTables[type.id] = [1 << square | sum(ray[0] for ray in squareRays)
+                                for square, squareRays in enumerate(rays(type))]
+    return reachTables[type.id]
+
+def buildRay(type, rank, file, k):
+    prop = directions[k]
+    movement = max(type.movement_limits[k], 0)
+    attack = max(type.attack_limits[k], 0)
+    targets, mask = [], 0
+    for i in range(1, max(movement, attack) + 1):
+        target_rank = rank + dirToCoordDelta[prop][1] * i
+        target_file = file + dirToCoordDelta[prop][0] * i
+        if not withinBoard(target_rank, target_file): break
+        targets.append((target_rank, target_file))
+        mask |= 1 << (target_rank * 8 + target_file)
+    if targets: return mask, tuple(targets), movement, attack, dirToSquareDelta[prop]
+
+# Zobrist keys are drawn from a generator seeded by the piece type's ranges
+# rather than its id, so every process agrees on the key of a position.
+zobristTables = []
+zobristTurn = Random(0).getrandbits(64)
+
+def zobrist(type: PieceType):
+    while len(zobristTables) <= type.id: zobristTables.append(None)
+    if zobristTables[type.id] is None:
+        generator = Random(hash((type.attack, type.movement)))
+        zobristTables[type.id] = ([generator.getrandbits(64) for _ in range(64)],
+                                  [generator.getrandbits(64) for _ in range(64)])
+    return zobristTables[type.id]
+
+def zobristKey(board: Board) -> int:
+    key = zobristTurn if board.player_turn else 0
+    for piece in board.player:
+        key ^= zobrist(piece.type)[0][piece.rank * 8 + piece.file]
+    for piece in board.opponent:
+        key ^= zobrist(piece.type)[1][piece.rank * 8 + piece.file]
+    return key
+
+@dataclass
+class BitBoard(Board):
+    squares: list = field(init=False, repr=False, compare=False)
+    player_mask: int = field(init=False, repr=False, compare=False)
+    opponent_mask: int = field(init=False, repr=False, compare=False)
+    key: int = field(init=False, repr=False, compare=False)
+    history: list = field(init=False, repr=False, compare=False)
+    own: list = field(init=False, repr=False, compare=False)
+    other: list = field(init=False, repr=False, compare=False)
+    kings: list = field(init=False, repr=False, compare=False)
+
+    # Set to check every incremental evaluation against a full one.
+    debug = False
+
+    def __post_init__(self): self.sync()
+
+    def sync(self):
+        self.squares = [None] * 64
+        self.player_mask = self.opponent_mask = 0
+        for piece in self.player:
+            self.squares[piece.rank * 8 + piece.file] = piece
+            self.player_mask |= 1 << (piece.rank * 8 + piece.file)
+        for piece in self.opponent:
+            self.squares[piece.rank * 8 + piece.file] = piece
+            self.opponent_mask |= 1 << (piece.rank * 8 + piece.file)
+        self.key, self.history = zobristKey(self), []
+        # Running pieceTerms sums and king counts, indexed by side.
+        self.own, self.other, self.kings = [0, 0], [0, 0], [0, 0]
+        for piece in self.opponent: self.count(piece, False, 1)
+        for piece in self.player: self.count(piece, True, 1)
+
+    def count(self, piece, player, sign):
+        own, other = pieceTerms(piece, player)
+        self.own[player] += sign * own
+        self.other[player] += sign * other
+        if piece.type == king: self.kings[player] += sign
+
+    def evaluate(self, king_value, perspective=True):
+        kings = self.kings[perspective] - self.kings[not perspective]
+        total = self.own[perspective] + self.other[not perspective] + king_value * kings
+        if self.debug: assert total == super().evaluate(king_value, perspective)
+        return total
+
+    def generateAllowed(board, piece):
+        square = piece.rank * 8 + piece.file
+        mine = board.squares[square] is piece and board.player_mask >> square & 1
+        if board.player_turn != bool(mine): return []
+        return board.targets(piece, board.player_turn)
+
+    def targets(board, piece, player):
+        square = piece.rank * 8 + piece.file
+        occupied = board.player_mask | board.opponent_mask
+        opponents = board.opponent_mask if player else board.player_mask
+        allowed = []
+        for mask, targets, movement, attack, step in rays(piece.type)[square]:
+            blockers = mask & occupied
+            if not blockers:
+                allowed.extend(targets[:movement])
+                continue
+            # The nearest blocker is the lowest bit on rays going up the
+            # board and the highest one on rays going down.
+            if step > 0: blocker = (blockers & -blockers).bit_length() - 1
+            else: blocker = blockers.bit_length() - 1
+            distance = (blocker - square) // step
+            allowed.extend(targets[:min(movement, distance - 1)])
+            if distance <= attack and opponents >> blocker & 1:
+                allowed.append(targets[distance - 1])
+        return allowed
+
+    def captures(board, piece):
+        square = piece.rank * 8 + piece.file
+        player = board.player_turn
+        if board.squares[square] is not piece or bool(board.player_mask >> square & 1) != player: return []
+        occupied = board.player_mask | board.opponent_mask
+        opponents = board.opponent_mask if player else board.player_mask
+        promoting = piece.type != king and piece.type != queen
+        last = 7 if player else 0
+        allowed = []
+        for mask, targets, movement, attack, step in rays(piece.type)[square]:
+            blockers = mask & occupied
+            if blockers:
+                if step > 0: blocker = (blockers & -blockers).bit_length() - 1
+                else: blocker = blockers.bit_length() - 1
+                distance = (blocker - square) // step
+            else: distance = len(targets) + 1
+            if promoting:
+                allowed.extend(t for t in targets[:min(movement, distance - 1)] if t[0] == last)
+            if blockers and distance <= attack and opponents >> blocker & 1:
+                allowed.append(targets[distance - 1])
+        return allowed
+
+    def quiets(board, piece):
+        square = piece.rank * 8 + piece.file
+        player = board.player_turn
+        if board.squares[square] is not piece or bool(board.player_mask >> square & 1) != player: return []
+        occupied = board.player_mask | board.opponent_mask
+        promoting = piece.type != king and piece.type != queen
+        last = 7 if player else 0
+        allowed = []
+        for mask, targets, movement, attack, step in rays(piece.type)[square]:
+            if not movement: continue
+            blockers = mask & occupied
+            if blockers:
+                if step > 0: blocker = (blockers & -blockers).bit_length() - 1
+                else: blocker = blockers.bit_length() - 1
+                targets = targets[:min(movement, (blocker - square) // step - 1)]
+            else: targets = targets[:movement]
+            if promoting: targets = [t for t in targets if t[0] != last]
+            allowed.extend(targets)
+        return allowed
+
+    def make_move(self, move):
+        mover = self.player_turn
+        self.count(move[0], mover, -1)
+        undo = super().make_move(move)
+        piece, rank, file, type, captured, _ = undo
+        self.count(piece, mover, 1)
+        if captured is not None: self.count(captured, not mover, -1)
+        source, target = rank * 8 + file, piece.rank * 8 + piece.file
+        self.squares[source], self.squares[target] = None, piece
+        side = self.player_turn
+        self.history.append(self.key)
+        self.key ^= zobristTurn ^ zobrist(type)[side][source] ^ \
+            zobrist(piece.type)[side][target]
+        if captured is not None:
+            self.key ^= zobrist(captured.type)[not side][target]
+        if side:
+            self.opponent_mask ^= 1 << source | 1 << target
+            self.player_mask &= ~(1 << target)
+        else:
+            self.player_mask ^= 1 << source | 1 << target
+            self.opponent_mask &= ~(1 << target)
+        return undo
+
+    def unmake_move(self, undo):
+        piece, rank, file, _, captured, _ = undo
+        source, target = rank * 8 + file, piece.rank * 8 + piece.file
+        mover = not self.player_turn
+        self.count(piece, mover, -1)
+        if captured is not None: self.count(captured, not mover, 1)
+        super().unmake_move(undo)
+        self.count(piece, mover, 1)
+        self.squares[source], self.squares[target] = piece, captured
+        self.key = self.history.pop()
+        if self.player_turn:
+            self.player_mask ^= 1 << source | 1 << target
+            if captured is not None: self.opponent_mask |= 1 << target
+        else:
+            self.opponent_mask ^= 1 << source | 1 << target
+            if captured is not None: self.player_mask |= 1 << target
+
+    def capture_index(self, pieces, rank, file):
+        square = rank * 8 + file
+        opponents = self.opponent_mask if self.player_turn else self.player_mask
+        if opponents >> square & 1: return pieces.index(self.squares[square])
 
 
 @dataclass
@@ -139,5 +501,31 @@ class Clock:
 
     @property
     def flipped(self):
-        return Clock(self.plys, self.opponent_time, self.time,
-                     self.total_time, self.increment)
+        return type(self)(self.plys, self.opponent_time, self.time,
+                          self.total_time, self.increment, self.last_move_start_time)
+
+    def snapshot(self): return ClockSnapshot(self.plys, self.time, self.opponent_time,
+        self.total_time, self.increment, self.last_move_start_time)
+
+
+# Player code is handed snapshots of the game instead of copies of it. Their
+# attributes are set once, and the pieces of a board snapshot are frozen
+# and kept in tuples, so player code can look at them and derive new boards
+# with flipped or copy, but never change the game itself.
+class ReadOnly:
+    def __setattr__(self, name, value):
+        if name in vars(self): raise AttributeError(f'{type(self).__name__} is read-only')
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name): raise AttributeError(f'{type(self).__name__} is read-only')
+
+class BoardSnapshot(ReadOnly, Board):
+    def __init__(self, opponent, player, player_turn=False):
+        super().__init__(tuple(p.frozen for p in opponent), tuple(p.frozen for p in player), player_turn)
+
+    def make_move(self, move):
+        raise AttributeError('Board snapshots cannot be played on, copy them first')
+
+    unmake_move = make_move
+
+class ClockSnapshot(ReadOnly, Clock): pass
@@ -2,147 +2,346 @@ from dataclasses import dataclass
 from time import sleep, time
 from random import choice, random
 from pprint import pprint
-from buildaboard import Range, PieceType, Piece, Move, Board, Clock, king, queen, files, ranks
+from buildaboard import Range, PieceType, Piece, Move, Board, BitBoard, Clock, king, queen, files, ranks, promotes
+from engine import TranspositionTable, TimeManager, EXACT, LOWER, UPPER, packMove, unpackMove, startPool, remote
+import tablebase
+
+INFINITY = 1000000
+MAX_PLY = 64
+# A lost king scores -(MATE - ply), so that quicker wins and slower losses
+# score better, in searched lines as in tablebase ones. Scores beyond
+# MATE_BOUND are kept in the table relative to the position, not the root.
+MATE = 10000
+MATE_BOUND = 9000
+# Delta pruning margin: the most a tactical move can add to the score
+# besides the material it wins, roughly the rank terms of both pieces.
+DELTA = 16
+
+table = TranspositionTable(1 << 16)
+search = {'nodes': 0, 'qnodes': 0, 'deadline': 0, 'stopped': False, 'best': None, 'interrupted': None}
+killers = [[None, None] for _ in range(MAX_PLY)]
+history = {}
+stats = {}
+verbose = False
+
+# Set workers to split the root moves over that many processes. Each
+# process deepens its own share of the moves; the move is then picked at
+# the deepest depth every process completed, so it only depends on the
+# time budget through that depth. Cap max_depth for reproducible games.
+workers = 0
+max_depth = MAX_PLY - 1
+
+# Set pondering to keep thinking on the opponent's time, in a sandbox: the
+# reply stored in the table is assumed, and the position after it deepened
+# until the real reply comes. If it was the predicted one, choosemove picks
+# up from the depth pondering reached.
+pondering = True
+pondered = {'key': None, 'depth': 0, 'best': None}
+
+# Endgames with few enough pieces are looked up in the tables tablebase.py
+# writes to this directory, if it has any for them.
+tablebases = tablebase.Tablebases('tablebases')
 
 def hash_board(board):
-    return hash(tuple((p.type, p.file, p.rank) for p in b.pieces))
+    return board.key
 
-def apply_move(board, piece, rank, file):
-    return Board(
-        [p for p in board.opponent if (p.rank, p.file) != (rank, file)],
-        [(Piece(queen if (piece.type != king and rank == 7) else piece.type, rank, file) if p == piece else p) for p in board.player],
-        player_turn = not board.player_turn
-        )
+def eval_b(board, perspective=True):
+    # The score is seen from the player's side if perspective is set, and
+    # from the opponent's side otherwise, as if the board had been flipped.
+    # A BitBoard keeps it up to date as moves are made.
+    return board.evaluate(10000, perspective)
+
+def value(piece, player):
+    # Priced from the side of the piece's owner, player telling whether it
+    # is board.player, as pieceTerms does for the evaluation.
+    type = piece.type if player else piece.type.flipped
+    return 10000 if type == king else type.price
+
+def order_moves(board, ply, hashed):
+    # Hash move first, then captures by most valuable victim / least
+    # valuable attacker, then killers, then quiet moves by history.
+    moves, player = [], board.player_turn
+    for piece in board.to_move:
+        source = (piece.rank * 8 + piece.file) << 6
+        for rank, file in board.generateAllowed(piece):
+            packed = source | rank * 8 + file
+            victim = board.squares[rank * 8 + file]
+            if packed == hashed: score = 1 << 40
+            elif victim is not None: score = (1 << 32) + value(victim, not player) * 1024 - value(piece, player)
+            elif packed in killers[ply]: score = 1 << 31
+            else: score = history.get(packed, 0)
+            moves.append((score, (piece, rank, file)))
+    return sorted(moves, key=lambda x: x[0], reverse=True)
+
+def order_captures(board):
+    # Most valuable victim / least valuable attacker; promotions count the
+    # queen as their victim. Each move comes with the most it can win.
+    moves, player = [], board.player_turn
+    for piece in board.to_move:
+        for rank, file in board.captures(piece):
+            victim = board.squares[rank * 8 + file]
+            gain = value(victim, not player) if victim is not None else 0
+            if promotes(piece, rank, player): gain += queen.price - value(piece, player)
+            moves.append((gain * 1024 - value(piece, player), gain, (piece, rank, file)))
+    return sorted(moves, key=lambda x: x[0], reverse=True)
 
-def eval_b(board):
-    total = 0
-    for piece in board.player:
-        if piece.type == king:
-            total += 10000
-            total -= piece.rank
-        else:
-            total += piece.type.price
-            total += piece.rank
-    for piece in board.opponent:
-        if piece.type == king:
-            total -= 10000
-            total += piece.rank
-        else:
-            total -= piece.type.flipped.price
-            total -= (7 - piece.rank)
-    return total
-
-def eval_moves(board, depth, cache, timelimit, cachesize):
-    assert board.player_turn, "Something went wrong with turns"
-    if not any(p.type == king for p in board.player): return -10000, None, None
-    if time() > timelimit: depth = min(depth, 1)
-    moves = {}
-
-    if cache:
-        for key in list(sorted(cache, key=lambda x: cache[x][0], reverse=True))[:cachesize]:
-            if cache[key][0] > 9000: return 10000, cache[key][1], None
-            if depth == 0:
-                moves[key] = cache[key]
-            else:
-                topval, _, subm = eval_moves(nb := cache[key][1], depth-1, cache[key][2], timelimit, cachesize)
-                moves[key] = (-topval, nb, subm)
-
-    else:
-        for piece in board.player:
-            allowed = board.generateAllowed(piece)
-            for (rank, file) in allowed:
-                new_board = apply_move(board, piece, rank, file)
-
-                flag = False
-                if rank == 7 and piece.type != king and piece.type != queen and depth == 0:
-                    depth += 1
-                    flag = True
-
-                if depth == 0:
-                    moves[(piece, rank, file)] = (eval_b(new_board), new_board.flipped, None)
-                else:
-                    topval, _, subm = eval_moves(nb := new_board.flipped, depth-1, None, timelimit, cachesize)
-                    moves[(piece, rank, file)] = (-topval, nb, subm)
-
-                if flag:
-                    depth -= 1
-                    flag = False
-
-    if not moves: return -10000, None, None
-    top = max(moves, key=lambda x: moves[x][0])
-    return moves[top][0], top, moves
+def count_node():
+    search['nodes'] = search['nodes'] + 1
+    if search['nodes'] & 1023 == 0 and (time() > search['deadline'] or
+            search['interrupted'] and search['interrupted']()):
+        search['stopped'] = True
+    return search['stopped']
+
+def toTable(score, ply):
+    if score > MATE_BOUND: return score + ply
+    if score < -MATE_BOUND: return score - ply
+    return score
+
+def fromTable(score, ply):
+    if score > MATE_BOUND: return score - ply
+    if score < -MATE_BOUND: return score + ply
+    return score
+
+def quiesce(board, alpha, beta, ply):
+    # Only tactical moves are searched, until the position is quiet, so
+    # that leaves are never scored in the middle of an exchange. The side
+    # to move may always stand pat on the static score.
+    search['qnodes'] = search['qnodes'] + 1
+    if count_node(): return 0
+    if not any(p.type == king for p in board.to_move): return ply - MATE
+    # Scored from the side that just moved, as eval_moves did.
+    best = stand = -eval_b(board, not board.player_turn)
+    if best >= beta or ply >= MAX_PLY - 1: return best
+    alpha = max(alpha, best)
+    for _, gain, move in order_captures(board):
+        # Delta pruning: not even winning all of it would raise alpha.
+        if stand + gain + DELTA <= alpha: continue
+        undo = board.make_move(move)
+        score = -quiesce(board, -beta, -alpha, ply + 1)
+        board.unmake_move(undo)
+        if search['stopped']: return 0
+        if score > best:
+            best = score
+            if best >= beta: break
+            alpha = max(alpha, best)
+    return best
+
+def negamax(board, depth, alpha, beta, ply):
+    if ply and (code := tablebases.probe(board)) is not None: return tablebase.score(code, MATE - ply)
+    if depth <= 0: return quiesce(board, alpha, beta, ply)
+    if count_node(): return 0
+    if not any(p.type == king for p in board.to_move): return ply - MATE
+    if ply >= MAX_PLY - 1: return -eval_b(board, not board.player_turn)
+
+    key = hash_board(board)
+    hashed = None
+    if entry := table.probe(key):
+        hashed = entry[3]
+        if ply and entry[0] >= depth:
+            score = fromTable(entry[2], ply)
+            if entry[1] == EXACT: return score
+            if entry[1] == LOWER: alpha = max(alpha, score)
+            else: beta = min(beta, score)
+            if alpha >= beta: return score
+
+    original_alpha, best, top = alpha, -INFINITY, None
+    for _, move in order_moves(board, ply, hashed):
+        score = search_move(board, move, depth, alpha, beta, ply)
+        if search['stopped']: return 0
+        if score > best:
+            best, top = score, move
+            if not ply: search['best'] = move
+        alpha = max(alpha, score)
+        if alpha >= beta:
+            piece, rank, file = move
+            if board.squares[rank * 8 + file] is None:
+                packed = packMove(move)
+                if killers[ply][0] != packed:
+                    killers[ply][1], killers[ply][0] = killers[ply][0], packed
+                history[packed] = history.get(packed, 0) + depth * depth
+            break
+
+    if top is None: return ply - MATE
+    bound = UPPER if best <= original_alpha else LOWER if best >= beta else EXACT
+    table.store(key, depth, bound, toTable(best, ply), packMove(top))
+    return best
 
 def setup():
 
-    if random() > .5:
-
-        pawn = PieceType(
-            Range(0, 1, 0, 0, 0, 0, 0, 0),
-            Range(0, 2, 1, 0, 0, 0, 0, 0)
-            )
-        bishop = PieceType(
-            Range(1, 1, 1, 0, 0, 0, 0, 0),
-            Range(0, 1, 0, 0, 0, 0, 0, 0)
-            )
-        rook = PieceType(
-            Range(0, 0, 0, 1, 2, 0, 0, 0),
-            Range(0, 0, 0, 1, 0, 0, 0, 0)
-            )
-
-        return [Piece(pawn, 2, 0),
-                Piece(pawn, 2, 1),
-                Piece(pawn, 2, 2),
-                Piece(pawn, 2, 3),
-                Piece(bishop, 1, 1),
-                Piece(bishop, 1, 3),
-                Piece(rook, 0, 1),
-                Piece(rook, 0, 5),
-                Piece(king, 0, 0)
-                ]
-
-    else:
-        pawn = PieceType(
-            Range(0, 1, 0, 0, 0, 0, 0, 0),
-            Range(0, 1, 0, 0, 0, 0, 0, 0)
-            )
-        return [Piece(pawn, 2, 3),
-                Piece(pawn, 2, 4),
-                Piece(pawn, 1, 0),
-                Piece(pawn, 1, 1),
-                Piece(pawn, 1, 2),
-                Piece(pawn, 1, 3),
-                Piece(pawn, 1, 4),
-                Piece(pawn, 1, 5),
-                Piece(pawn, 1, 6),
-                Piece(pawn, 1, 7),
-                Piece(king, 0, 3),
-                ]
-
-
-def trace(moves, inv=-1):
-    if not moves: return 'xxx'
-    piece, rank, file = max(moves, key=lambda x: moves[x][0])
-    if m := moves[(piece, rank, file)][2]:
-        t, m = trace(m, inv*-1)
-    else: t, m = '', None
-    return (f'{piece.rank}:{piece.file} → {rank}:{file} ({moves[(piece, rank, file)][0]} - {eval_b(moves[(piece, rank, file)][1])});  ' + t, m if m else repr_board(moves[(piece, rank, file)][1]))
-
-def repr_board(board): return eval_b(board)
-
-def choosemove(board, maxtime):
-    moves, oldmoves = None, None
+    if workers: startPool(workers)
+
+    if random() > .5: return mixed_setup()
+    else: return pawn_setup()
+
+def mixed_setup():
+
+    pawn = PieceType(
+        Range(0, 1, 0, 0, 0, 0, 0, 0),
+        Range(0, 2, 1, 0, 0, 0, 0, 0)
+        )
+    bishop = PieceType(
+        Range(1, 1, 1, 0, 0, 0, 0, 0),
+        Range(0, 1, 0, 0, 0, 0, 0, 0)
+        )
+    rook = PieceType(
+        Range(0, 0, 0, 1, 2, 0, 0, 0),
+        Range(0, 0, 0, 1, 0, 0, 0, 0)
+        )
+
+    return [Piece(pawn, 2, 0),
+            Piece(pawn, 2, 1),
+            Piece(pawn, 2, 2),
+            Piece(pawn, 2, 3),
+            Piece(bishop, 1, 1),
+            Piece(bishop, 1, 3),
+            Piece(rook, 0, 1),
+            Piece(rook, 0, 5),
+            Piece(king, 0, 0)
+            ]
+
+def pawn_setup():
+
+    pawn = PieceType(
+        Range(0, 1, 0, 0, 0, 0, 0, 0),
+        Range(0, 1, 0, 0, 0, 0, 0, 0)
+        )
+    return [Piece(pawn, 2, 3),
+            Piece(pawn, 2, 4),
+            Piece(pawn, 1, 0),
+            Piece(pawn, 1, 1),
+            Piece(pawn, 1, 2),
+            Piece(pawn, 1, 3),
+            Piece(pawn, 1, 4),
+            Piece(pawn, 1, 5),
+            Piece(pawn, 1, 6),
+            Piece(pawn, 1, 7),
+            Piece(king, 0, 3),
+            ]
+
+
+def search_move(board, move, depth, alpha, beta, ply):
+    # Promotions are left to quiesce, as they are tactical moves.
+    undo = board.make_move(move)
+    score = -negamax(board, depth - 1, -beta, -alpha, ply + 1)
+    board.unmake_move(undo)
+    return score
+
+def reset(deadline, interrupted=None):
+    search.update(nodes=0, qnodes=0, deadline=deadline, stopped=False, best=None, interrupted=interrupted)
+    for slots in killers: slots[0] = slots[1] = None
+    history.clear()
+
+def search_root(board, moves, depth_limit, deadline):
+    # Deepens over a share of the root moves; returns the best (score,
+    # packed move, nodes so far) of every completed depth and the nodes
+    # searched. The table starts empty, so that the results do not depend
+    # on what the worker searched for earlier moves.
+    reset(deadline)
+    table.clear()
+    results = []
+    for depth in range(1, depth_limit + 1):
+        alpha, top = -INFINITY, None
+        for packed in moves:
+            score = search_move(board, unpackMove(board, packed), depth, alpha, INFINITY, 0)
+            if search['stopped']: return results, search['nodes']
+            if score > alpha: alpha, top = score, packed
+        results.append((alpha, top, search['nodes']))
+        moves = [top] + [packed for packed in moves if packed != top]
+        if abs(alpha) > MATE_BOUND: break
+    return results, search['nodes']
+
+def parallel_choosemove(board, timer):
+    # Workers cannot be asked between iterations, so they stop at the soft
+    # deadline.
     start = time()
-    depth = 2
-    cachesize = {1: 9, 2: 8, 3: 7, 4: 6, 5: 5, 6: 5, 7: 4, 8: 4}
-    while time() - start < maxtime:
-        ev, top, moves = eval_moves(board, depth, moves, start+maxtime, cachesize.get(depth, 3))
-        #print('>>>', depth, ev, round(time() - start, 2))
+    reset(timer.start + timer.soft)
+    moves = [packMove(move) for _, move in order_moves(board, 0, None)]
+    chunks = [moves[i::workers] for i in range(min(workers, len(moves)))]
+    futures = [startPool(workers).submit(remote, 'builtin_ai2', 'search_root', board, chunk, max_depth,
+                                         timer.start + timer.soft)
+               for chunk in chunks]
+    results = [future.result() for future in futures]
+    if not results: return None
+    depth, elapsed, nodes = min(len(r) for r, _ in results), time() - start, 0
+    for _, n in results: nodes = nodes + n
+    if not depth: return unpackMove(board, moves[0])
+    # A mate found early by one process ends its deepening, so compare
+    # at the deepest depth everybody reached, preferring earlier moves.
+    score, _, packed = max((r[depth - 1][0], -moves.index(r[depth - 1][1]), r[depth - 1][1]) for r, _ in results)
+    # The branching factor compares the nodes every process spent on the
+    # last iteration with those of the one before it.
+    spent = lambda r, d: (r[d - 1][2] - (r[d - 2][2] if d > 1 else 0)) if d else 0
+    last = previous = 0
+    for r, _ in results: last, previous = last + spent(r, depth), previous + spent(r, depth - 1)
+    stats.clear()
+    stats.update(depth=depth, score=score, nodes=nodes, time=elapsed,
+                 nps=nodes / elapsed if elapsed else 0, ebf=last / previous if previous else 0,
+                 workers=len(results))
+    return unpackMove(board, packed)
+
+def trace(board, depth):
+    line, undos = [], []
+    while len(undos) < depth and (entry := table.probe(hash_board(board))) \
+            and (move := unpackMove(board, entry[3])):
+        piece, rank, file = move
+        line.append(f'{piece.rank}:{piece.file} → {rank}:{file}')
+        undos.append(board.make_move(move))
+    for undo in undos[::-1]: board.unmake_move(undo)
+    return ';  '.join(line)
+
+def choosemove(board, budget):
+    # The budget is a TimeManager, or seconds to spend at most.
+    timer = budget if isinstance(budget, TimeManager) else TimeManager(budget, budget)
+    board = board.copy(BitBoard)
+    if workers: return parallel_choosemove(board, timer)
+    start = time()
+    reset(timer.deadline)
+    stats.clear()
+    top, depth, previous = None, 1, 0
+    if pondered['key'] == hash_board(board):
+        top, depth = unpackMove(board, pondered['best']), pondered['depth'] + 1
+        stats.update(pondered=pondered['depth'], depth=pondered['depth'])
+    while depth <= max_depth:
+        nodes = search['nodes']
+        score = negamax(board, depth, -INFINITY, INFINITY, 0)
+        if search['stopped']: break
+        top, elapsed, nodes = search['best'], time() - start, search['nodes'] - nodes
+        # The effective branching factor compares the cost of an iteration
+        # with the one before it.
+        stats.update(depth=depth, score=score, nodes=search['nodes'], qnodes=search['qnodes'], time=elapsed,
+                     nps=search['nodes'] / elapsed if elapsed else 0,
+                     ebf=nodes / previous if previous else 0)
+        previous = nodes
+        if verbose: print('>>>', stats)
+        if abs(score) > MATE_BOUND: break
+        if not timer.next_iteration(packMove(top), stats['ebf']): break
         depth += 1
-    return top
+    if top or search['best']: return top or search['best']
+    moves = order_moves(board, 0, None)
+    if moves: return moves[0][1]
 
-def move(board, clock) -> Move:
+def ponder(board, move, clock, interrupted):
+    pondered.update(key=None, depth=0, best=None)
+    if not pondering or workers: return
+    board = board.copy(BitBoard)
+    piece, rank, file = move
+    board.make_move((board.squares[piece.rank * 8 + piece.file], rank, file))
+    entry = table.probe(hash_board(board))
+    if not entry or entry[3] is None: return
+    board.make_move(unpackMove(board, entry[3]))
+    # No longer than the opponent has left to think, if the host does not
+    # interrupt it sooner.
+    reset(time() + max(clock.opponent_time, 0), interrupted)
+    for depth in range(1, max_depth + 1):
+        score = negamax(board, depth, -INFINITY, INFINITY, 0)
+        if search['stopped'] or search['best'] is None: break
+        pondered.update(key=hash_board(board), depth=depth, best=packMove(search['best']))
+        if abs(score) > MATE_BOUND: break
 
-    #print('Time left:', clock.time)
-    allocated = clock.increment * (.2 + 3 * (clock.time / clock.total_time))
-    #print('Allocated:', allocated)
-    return Move(*choosemove(board, allocated))
+def move(board, clock) -> Move:
+    timer = TimeManager.fromClock(clock)
+    top = choosemove(board, timer)
+    # What the host shows or logs of this move, along with its own timings.
+    stats.update(allocated=timer.soft, hard=timer.hard, used=timer.elapsed, clock=clock.time,
+                 tablebase_hits=tablebases.hits, pv=trace(board.copy(BitBoard), stats.get('depth', 0)), table=table.stats)
+    if top: return Move(*top)
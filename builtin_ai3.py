@@ -1,59 +1,311 @@
+from array import array
 from dataclasses import dataclass
+from math import exp, log, sqrt
 from time import sleep, time
-from random import choice
-from buildaboard import Range, PieceType, Piece, Move, Board, Clock, king, queen, files, ranks
+from random import Random, choice, getrandbits
+from buildaboard import Range, PieceType, Piece, Move, Board, BitBoard, Clock, king, queen, files, ranks
+from engine import TimeManager, packMove, unpackMove, startPool, remote
 
-def hash_board(board):
-    return hash(tuple((p.type, p.file, p.rank) for p in b.pieces))
+try:
+    from rollouts import Rollouts
+    import numpy as np
+except ModuleNotFoundError:
+    Rollouts = None
 
-def apply_move(board, piece, rank, file):
-    return Board(
-        [p for p in board.opponent if (p.rank, p.file) != (rank, file)],
-        [(Piece(queen if (piece.type != king and rank == 7) else piece.type, rank, file) if p == piece else p) for p in board.player],
-        player_turn = not board.player_turn
-        )
+# Moves are chosen by UCT tree search; see Tree. Set workers to play flat
+# Monte Carlo instead, spreading root moves over that many processes.
+# Playouts draw from generators seeded from seed and the position, so a
+# fixed seed always picks the same move after the same number of
+# iterations.
+workers = 0
+seed = None
 
-def eval_b(board):
-    total = 0
-    for piece in board.player:
-        if piece.type == king:
-            total += 1000
-            total -= piece.rank
-        else:
-            total += piece.type.price
-            total += piece.rank
-    for piece in board.opponent:
-        if piece.type == king:
-            total -= 1000
-            total += piece.rank
-        else:
-            total -= piece.type.flipped.price
-            total -= (7 - piece.rank)
-    return total
+# The tree holds at most max_nodes nodes; iterations is how many a search
+# without a clock runs, and every playout goes playout_depth plies deep.
+max_nodes = 1 << 18
+iterations = 2000
+playout_depth = 2
+exploration = .7
+# Evaluation points by which a position is about 73% won: rewards are a
+# sigmoid of playout scores.
+reward_scale = 100
+
+# Playouts per depth for every root move: the NumPy rollouts run all of
+# them at once, so they can afford many more.
+playouts = 40
+batch_playouts = 400
+stats = {}
+
+def eval_b(board, perspective=True):
+    return board.evaluate(1000, perspective)
 
 def f(x):
     if x > 0: return x
     else: return 10*x
 
-def play(board, depth):
-    if depth == 0: return eval_b(board)
-    if not any(p.type == king for p in board.player): return -1000
-    moves = [(piece, rank, file) for piece in board.player for (rank, file) in board.generateAllowed(piece)]
+def play(board, depth, choice=choice):
+    if depth == 0: return eval_b(board, board.player_turn)
+    if not any(p.type == king for p in board.to_move): return -1000
+    moves = [(piece, rank, file) for piece in board.to_move for (rank, file) in board.generateAllowed(piece)]
     if not moves: return -1000
-    move = choice(moves)
-    return -play(apply_move(board, *move).flipped, depth-1)
-
-def choosemove(board):
-    moves = {}
-    for piece in board.player:
-        for (rank, file) in board.generateAllowed(piece):
-            score = sum(f(-play(apply_move(board, piece, rank, file).flipped, d))/100 for d in range(7) for i in range(40))
-            moves[(piece, rank, file)] = score
-    top = max(moves, key=moves.get)
-    return top
+    undo = board.make_move(choice(moves))
+    score = -play(board, depth-1, choice)
+    board.unmake_move(undo)
+    return score
+
+def playout(board, move, depth, choice=choice):
+    undo = board.make_move(move)
+    score = -play(board, depth, choice)
+    board.unmake_move(undo)
+    return score
+
+def score_moves(board, moves, seed, count=None):
+    # Plays count playouts per depth for every move, or all of them.
+    scores = []
+    for packed in moves:
+        move = unpackMove(board, packed)
+        if Rollouts:
+            rng = np.random.default_rng(hash((seed, board.key, packed)) % 2**64)
+            undo = board.make_move(move)
+            results = Rollouts(board, 1000).run(np.repeat(np.arange(7), count or batch_playouts), rng)
+            board.unmake_move(undo)
+            scores.append(float(results.clip(min=0).sum() + 10 * results.clip(max=0).sum()) / 100)
+        else:
+            choice = Random(hash((seed, board.key, packed))).choice
+            score = 0
+            for d in range(7):
+                for i in range(count or playouts): score = score + f(playout(board, move, d, choice))/100
+            scores.append(score)
+    return scores
+
+def rounds(total):
+    # Playouts per depth in every round: each one plays as many as all the
+    # ones before it, so that the clock can stop them in between.
+    counts, played = [1], 1
+    while played < total:
+        counts.append(min(played, total - played))
+        played = played + counts[-1]
+    return counts
+
+def flat_choosemove(board, timer=None):
+    # Scores every move over all the rounds of playouts, or as many of them
+    # as the TimeManager allows.
+    start = time()
+    board = board.copy(BitBoard)
+    moves = [packMove((piece, rank, file)) for piece in board.player for (rank, file) in board.generateAllowed(piece)]
+    if not moves: return None
+    move_seed = getrandbits(64) if seed is None else seed
+    scores, played = {packed: 0 for packed in moves}, 0
+    counts = rounds(batch_playouts if Rollouts else playouts)
+    for number in range(len(counts)):
+        count = counts[number]
+        round_seed = hash((move_seed, number))
+        if workers:
+            chunks = [moves[i::workers] for i in range(min(workers, len(moves)))]
+            futures = [startPool(workers).submit(remote, 'builtin_ai3', 'score_moves', board, chunk,
+                                                 round_seed, count)
+                       for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                for packed, score in zip(chunk, future.result()): scores[packed] = scores[packed] + score
+        else:
+            for packed, score in zip(moves, score_moves(board, moves, round_seed, count)):
+                scores[packed] = scores[packed] + score
+        played += count
+        if timer and not timer.next_iteration(max(moves, key=scores.get), 2): break
+    top = max(moves, key=scores.get)
+    elapsed = time() - start
+    total = len(moves) * 7 * played
+    stats.clear()
+    stats.update(moves=len(moves), rounds=number + 1, playouts=total, time=elapsed,
+                 playouts_per_second=total / elapsed if elapsed else 0)
+    return unpackMove(board, top)
+
+
+class Tree:
+    # A UCT tree in flat arrays. Node i was reached by the packed move
+    # moves[i], and visits[i] playouts through it scored values[i] in all,
+    # for the side that made that move. Its children are the count[i] nodes
+    # from first[i] on, first[i] being -1 until it is expanded; terminal[i]
+    # is set once it is expanded without children, lost for the side to
+    # move. Node 0 is the
+    # root. Once a move is chosen, played is its node and board the
+    # position after it, so that the next search can start from the node
+    # of the answer to it.
+
+    def __init__(self, size: int):
+        self.size = size
+        self.clear()
+        self.board, self.played = None, None
+        self.pruned = 0
+
+    def clear(self):
+        self.moves = array('I', bytes(4 * self.size))
+        self.visits = array('I', bytes(4 * self.size))
+        self.values = array('d', bytes(8 * self.size))
+        self.first = array('i', [-1]) * self.size
+        self.count = array('H', bytes(2 * self.size))
+        self.terminal = array('b', bytes(self.size))
+        self.used = 1
+
+    def children(self, node): return range(self.first[node], self.first[node] + self.count[node])
+
+    def expand(self, node, board, rng):
+        # Children come in random order, so that ties among unvisited ones
+        # do not always go to the same piece.
+        if not any(p.type == king for p in board.to_move): moves = []
+        else: moves = [packMove((piece, rank, file)) for piece in board.to_move
+                       for rank, file in board.generateAllowed(piece)]
+        if self.used + len(moves) > self.size: return False
+        rng.shuffle(moves)
+        self.first[node], self.count[node], self.terminal[node] = self.used, len(moves), int(not moves)
+        for i, packed in zip(range(self.used, self.used + len(moves)), moves):
+            self.moves[i], self.visits[i], self.values[i], self.first[i], self.count[i] = packed, 0, 0., -1, 0
+            self.terminal[i] = 0
+        self.used = self.used + len(moves)
+        return True
+
+    def select(self, node):
+        visits, values = self.visits, self.values
+        scale = exploration * sqrt(log(visits[node] + 1))
+        best, top = None, -1.
+        for child in self.children(node):
+            if not visits[child]: return child
+            score = values[child] / visits[child] + scale / sqrt(visits[child])
+            if score > top: best, top = child, score
+        return best
+
+    def iterate(self, board, rng):
+        # One playout: down the tree by UCT, expanding the node it stops at
+        # if it was visited before, then randomly from there on.
+        node, path, undos = 0, [0], []
+        while self.first[node] >= 0 and self.count[node]:
+            node = self.select(node)
+            undos.append(board.make_move(unpackMove(board, self.moves[node])))
+            path.append(node)
+        if not self.terminal[node] and self.first[node] < 0 and (self.visits[node] or node == 0) \
+                and self.expand(node, board, rng) and self.count[node]:
+            node = self.first[node] + rng.randrange(self.count[node])
+            undos.append(board.make_move(unpackMove(board, self.moves[node])))
+            path.append(node)
+        if self.terminal[node]: won = 0.
+        else: won = 1 / (1 + exp(-play(board, playout_depth, rng.choice) / reward_scale))
+        for undo in undos[::-1]: board.unmake_move(undo)
+        # won is for the side to move at the end of the path, the reverse
+        # for the one who moved into it.
+        reward = 1 - won
+        for node in path[::-1]:
+            self.visits[node] = self.visits[node] + 1
+            self.values[node] = self.values[node] + reward
+            reward = 1 - reward
+        return len(path) - 1
+
+    def compact(self, root, budget):
+        # Copies the subtree of root over to new arrays, as root, dropping
+        # the children of the least visited nodes so that at most budget
+        # nodes are left. Children have no more visits than their parent,
+        # so the nodes kept are always joined to the root.
+        expanded, stack = [], [root]
+        while stack:
+            node = stack.pop()
+            if self.first[node] >= 0 and self.count[node]:
+                expanded.append(node)
+                stack.extend(self.children(node))
+        expanded.sort(key=lambda node: -self.visits[node])
+        kept, threshold = 1, 0
+        for node in expanded:
+            if kept + self.count[node] > budget:
+                threshold = self.visits[node] + 1
+                break
+            kept += self.count[node]
+        if threshold:
+            self.pruned = self.pruned + 1
+            # Ties with the node that did not fit go too.
+            expanded = [node for node in expanded if self.visits[node] >= threshold]
+        keep = {node for node in expanded}
+
+        moves, visits, values, first, count = self.moves, self.visits, self.values, self.first, self.count
+        terminal = self.terminal
+        self.clear()
+        nodes = [root]
+        self.moves[0], self.visits[0], self.values[0] = moves[root], visits[root], values[root]
+        self.terminal[0] = terminal[root]
+        new = 0
+        while new < len(nodes):
+            node = nodes[new]
+            if node in keep:
+                self.first[new], self.count[new] = self.used, count[node]
+                for child in range(first[node], first[node] + count[node]):
+                    i = self.used
+                    self.moves[i], self.visits[i], self.values[i] = moves[child], visits[child], values[child]
+                    self.terminal[i] = terminal[child]
+                    nodes.append(child)
+                    self.used = self.used + 1
+            new = new + 1
+        return len(nodes)
+
+    def best(self):
+        return max(self.children(0), key=lambda child: self.visits[child])
+
+    def reuse(self, board) -> bool:
+        # Makes the node of board, reached by an answer to the move played,
+        # the new root if it is in the tree.
+        if self.board is None or self.played is None or self.first[self.played] < 0: return False
+        last = self.board
+        for node in self.children(self.played):
+            undo = last.make_move(unpackMove(last, self.moves[node]))
+            found = last.key == board.key and last.player_turn == board.player_turn
+            last.unmake_move(undo)
+            if found:
+                self.compact(node, self.size)
+                return True
+        return False
+
+tree = None
+
+def choosemove(board, timer=None):
+    # Grows the tree from the current position, or from what is left of
+    # the last one if the game went on through it, for as long as the
+    # TimeManager allows, or for the given number of iterations, and plays
+    # the most visited move.
+    global tree
+    if workers: return flat_choosemove(board, timer)
+    start = time()
+    board = board.copy(BitBoard)
+    if tree is None or tree.size != max_nodes: tree = Tree(max_nodes)
+    reused = tree.reuse(board)
+    if not reused: tree.clear()
+    tree.board, tree.played = board.copy(BitBoard), None
+    rng = Random(hash((getrandbits(64) if seed is None else seed, board.key)))
+    if tree.first[0] < 0 and not tree.expand(0, board, rng): return None
+    if not tree.count[0]: return None
+    reused_visits = tree.visits[0]
+    done, depth, batch = 0, 0, 16
+    while True:
+        for _ in range(batch):
+            if timer and timer.elapsed > timer.hard: break
+            # Some room is always kept for the largest expansion.
+            if tree.used + 1024 > tree.size: tree.compact(0, tree.size // 2)
+            depth = max(depth, tree.iterate(board, rng))
+            done += 1
+        if timer is None:
+            if done >= iterations: break
+            batch = min(batch, iterations - done)
+        elif not timer.next_iteration(tree.moves[tree.best()], 2): break
+        else: batch = min(2 * batch, 1024)
+    top = tree.best()
+    tree.played = top
+    tree.board.make_move(unpackMove(tree.board, tree.moves[top]))
+    elapsed = time() - start
+    stats.clear()
+    stats.update(moves=tree.count[0], iterations=done, nodes=tree.used, reused=reused_visits, depth=depth,
+                 pruned=tree.pruned, visits=tree.visits[top], score=tree.values[top] / max(tree.visits[top], 1),
+                 time=elapsed, nps=done / elapsed if elapsed else 0)
+    return unpackMove(board, tree.moves[top])
 
 def setup():
 
+    if workers: startPool(workers)
+
     pawn = PieceType(
         Range(0, 1, 0, 0, 0, 0, 0, 0),
         Range(0, 2, 1, 0, 0, 0, 0, 0)
@@ -79,4 +331,7 @@ def setup():
             ]
 
 def move(board, clock) -> Move:
-    return Move(*choosemove(board))
+    timer = TimeManager.fromClock(clock)
+    top = choosemove(board, timer)
+    stats.update(allocated=timer.soft, hard=timer.hard, used=timer.elapsed, clock=clock.time)
+    if top: return Move(*top)
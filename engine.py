@@ -0,0 +1,135 @@
+from concurrent.futures import ProcessPoolExecutor
+from importlib import import_module
+from time import time
+from buildaboard import BitBoard, Clock
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+def packMove(move) -> int:
+    piece, rank, file = move
+    return (piece.rank * 8 + piece.file) << 6 | rank * 8 + file
+
+def unpackMove(board: BitBoard, packed: int):
+    piece = board.squares[packed >> 6]
+    if piece is not None: return piece, (packed & 63) >> 3, packed & 7
+
+class TranspositionTable:
+    # Every bucket holds two entries: the first one is only replaced by
+    # searches at least as deep, the second one is always replaced. Entries
+    # are (depth, bound, score, packed best move) tuples.
+
+    def __init__(self, buckets: int = 1 << 16):
+        self.mask = buckets - 1
+        assert buckets & self.mask == 0, "Bucket count must be a power of two"
+        self.keys = [None] * (2 * buckets)
+        self.entries = [None] * (2 * buckets)
+        self.hits = self.misses = self.collisions = 0
+
+    @classmethod
+    def sized(cls, megabytes: float):
+        # Roughly 200 bytes per bucket: two keys, two entry tuples and
+        # the ints inside them.
+        buckets = 1
+        while buckets * 2 * 200 <= megabytes * 2**20: buckets *= 2
+        return cls(buckets)
+
+    def probe(self, key: int):
+        index = (key & self.mask) << 1
+        if self.keys[index] == key:
+            self.hits += 1
+            return self.entries[index]
+        if self.keys[index + 1] == key:
+            self.hits += 1
+            return self.entries[index + 1]
+        self.misses += 1
+
+    def store(self, key: int, depth: int, bound: int, score: int, move=None):
+        index = (key & self.mask) << 1
+        entry = (depth, bound, score, move)
+        if self.keys[index] == key or self.entries[index] is None or \
+                self.entries[index][0] <= depth:
+            if self.keys[index] not in (None, key): self.collisions += 1
+            self.keys[index], self.entries[index] = key, entry
+        else:
+            if self.keys[index + 1] not in (None, key): self.collisions += 1
+            self.keys[index + 1], self.entries[index + 1] = key, entry
+
+    def clear(self):
+        self.keys = [None] * len(self.keys)
+        self.entries = [None] * len(self.entries)
+        self.hits = self.misses = self.collisions = 0
+
+    @property
+    def stats(self):
+        probes = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'collisions': self.collisions,
+                'hit_rate': self.hits / probes if probes else 0,
+                'filled': 1 - self.keys.count(None) / len(self.keys)}
+
+
+class TimeManager:
+    # Deadlines for one move. The search gives up at the hard one; between
+    # iterations, next_iteration tells whether to start another one: not
+    # past the soft deadline, which comes sooner the longer the best move
+    # has stayed the same, nor when the next iteration, predicted from the
+    # branching factor of the last ones, could not finish by the hard one.
+
+    moves_to_go = 40        # moves a side is expected to play in a game
+    minimum_moves = 10
+    overhead = .05          # seconds lost to handing the move over
+    branching = 4           # assumed before there is an iteration to go by
+
+    def __init__(self, soft: float, hard: float, start: float = None):
+        self.start = time() if start is None else start
+        self.soft, self.hard = soft, hard
+        self.best, self.stable, self.finished, self.last = None, 0, 0, 0
+
+    @classmethod
+    def fromClock(cls, clock: Clock):
+        # An even share of the time left over the moves still to come, plus
+        # most of the increment, more of it when ahead of the opponent on
+        # the clock and less when behind. The hard deadline always leaves
+        # half of the time left.
+        left = max(clock.time - cls.overhead, 0)
+        moves = max(cls.moves_to_go - clock.plys // 2, cls.minimum_moves)
+        balance = min(max(clock.time / clock.opponent_time, .5), 2) ** .5 if clock.opponent_time > 0 else 1
+        soft = (left / moves + clock.increment * .8) * balance
+        hard = min(soft * 4, left / 2)
+        # Time already went by since the host started the clock.
+        start = clock.last_move_start_time
+        if not start or not 0 <= time() - start < left: start = None
+        return cls(min(soft, hard), hard, start)
+
+    @property
+    def deadline(self): return self.start + self.hard
+
+    @property
+    def elapsed(self): return time() - self.start
+
+    def next_iteration(self, best, branching: float = None) -> bool:
+        now = self.elapsed
+        self.stable = self.stable + 1 if best == self.best else 0
+        self.best, self.last, self.finished = best, now - self.finished, now
+        if now >= self.soft * max(.4, 1 - .15 * self.stable): return False
+        return now + self.last * (branching or self.branching) < self.hard
+
+
+# Parallel search runs on a single pool of worker processes that is kept
+# alive across moves, so that only the first move of a game pays for it.
+pool = {'executor': None, 'workers': 0}
+
+def startPool(workers: int) -> ProcessPoolExecutor:
+    if pool['executor'] is None or pool['workers'] != workers:
+        stopPool()
+        pool.update(executor=ProcessPoolExecutor(workers), workers=workers)
+    return pool['executor']
+
+def stopPool():
+    if pool['executor'] is not None: pool['executor'].shutdown(cancel_futures=True)
+    pool.update(executor=None, workers=0)
+
+def remote(module: str, function: str, *args):
+    # Player code is not importable by name, so workers look the engine
+    # function up in the real module instead of unpickling it.
+    return getattr(import_module(module), function)(*args)
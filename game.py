@@ -0,0 +1,129 @@
+from contextlib import nullcontext
+from dataclasses import dataclass
+from time import time
+from typing import Optional
+from buildaboard import Board, Clock, king, files, ranks
+from record import RecordWriter
+from metrics import Metrics
+
+def verify_setup(setup) -> Optional[str]:
+    if any(p.rank > 2 for p in setup):
+        return 'Somebody attempted to put a place further than the first three ranks on setup. That\'s invalid!'
+    elif sum(p.type.price for p in setup if p.type != king) > 200:
+        return 'Somebody attempted to put more than 200 points of pieces! That\'s invalid.'
+    elif not any(p.type == king for p in setup):
+        return 'Somebody did not put a king in their initial configuration!'
+
+def verify_move(move, board) -> Optional[str]:
+    if not any((p.rank, p.file, p.type) == (move.piece.rank, move.piece.file, move.piece.type) for p in board.player):
+        return 'Invalid move: piece to be moved does not exist / not in the right position'
+    if not board.check_move(move):
+        return 'Invalid move attempted'
+
+@dataclass
+class Game:
+    board: Board
+    clock: Clock
+    winner: Optional[bool] = None
+    result: Optional[str] = None
+    last_move: Optional[tuple] = None
+    white_used: float = 0
+    black_used: float = 0
+    record: Optional[RecordWriter] = None
+    metrics: Optional[Metrics] = None
+
+    def end(self, winner, reason):
+        self.winner, self.result = winner, reason
+        if self.record:
+            self.record.end(winner, reason)
+            self.record = None
+        if self.metrics: self.metrics.note(result=reason)
+        return reason
+
+    def move_done(self, source, target) -> Optional[str]:
+        # Plays a move given in algebraic squares, returning why the game
+        # ended if it did.
+        file, rank = files.index(source[0]), ranks.index(source[1])
+        target_file, target_rank = files.index(target[0]), ranks.index(target[1])
+        board, clock = self.board, self.clock
+        self.last_move = None
+
+        # Updates the clock
+        clock.plys += 1
+        elapsed = time() - clock.last_move_start_time
+        if board.player_turn:
+            clock.time -= elapsed
+            self.white_used += elapsed
+            if clock.time < 0: return self.end(False, 'White lost on time!')
+            clock.time += clock.increment
+        else:
+            clock.opponent_time -= elapsed
+            self.black_used += elapsed
+            if clock.opponent_time < 0: return self.end(True, 'Black lost on time!')
+            clock.opponent_time += clock.increment
+        if self.metrics:
+            self.metrics.note(ply=clock.plys, side='white' if board.player_turn else 'black',
+                              move=source + target, used=elapsed,
+                              time_left=clock.time if board.player_turn else clock.opponent_time)
+
+        # Updates the board
+        if self.record:
+            self.record.move(rank * 8 + file, target_rank * 8 + target_file,
+                             clock.time if board.player_turn else clock.opponent_time)
+        for piece in board.pieces:
+            if piece.file == target_file and piece.rank == target_rank and piece.type == king:
+                if piece in board.opponent:
+                    return self.end(True, 'Black lost their king! Game over.')
+                else: return self.end(False, 'White lost their king! Game over.')
+        for piece in board.pieces:
+            if piece.file == file and piece.rank == rank:
+                self.last_move = board.make_move((piece, target_rank, target_file))
+                break
+
+
+def play(white, black, total_time=60, increment=1, max_plys=500, record=None, metrics=None) -> Game:
+    # Plays a whole game between two players without any GUI. A player is
+    # anything with the setup and move functions of a player script, such
+    # as the builtin_ai2 module. If record is a path, the game is written
+    # there move by move; see record.py. Given a Metrics, every ply is
+    # timed and the stats the players keep are noted along with it;
+    # without one, nothing is kept.
+    clock = Clock(0, total_time, total_time, total_time, increment)
+    timed = metrics.timed if metrics else lambda name: nullcontext()
+    profiled = metrics.profiled if metrics else nullcontext
+    game = Game(Board([], [], False), clock, metrics=metrics)
+    white_setup, black_setup = white.setup(), black.setup()
+    if error := verify_setup(white_setup) or verify_setup(black_setup):
+        game.end(not verify_setup(white_setup), error)
+        return game
+    game.board = Board([p.flipped for p in black_setup], white_setup, False)
+    if record: game.record = RecordWriter(record, game.board, clock)
+
+    while not game.result:
+        if clock.plys >= max_plys:
+            game.end(None, 'Too many moves, the game is a draw.')
+            break
+        turn = game.board.player_turn
+        clock.last_move_start_time = time()
+        player = white if turn else black
+        with timed('snapshot'):
+            board = game.board.snapshot() if turn else game.board.snapshot().flipped
+            snapshot = clock.snapshot() if turn else clock.snapshot().flipped
+        try:
+            with timed('engine'), profiled(): move = player.move(board, snapshot)
+            if metrics and isinstance(getattr(player, 'stats', None), dict): metrics.note(engine=dict(player.stats))
+            with timed('validation'):
+                error = verify_move(move, board) if move else ('White lost!' if turn else 'Black lost!')
+        except TimeoutError:
+            error = 'White lost on time!' if turn else 'Black lost on time!'
+        except Exception as e:
+            error = 'Python error in custom code: ' + str(e)
+        if error:
+            game.end(not turn, error)
+            break
+        if not turn: move = move.flipped
+        game.move_done(files[move.piece.file] + ranks[move.piece.rank],
+                       files[move.file] + ranks[move.rank])
+        if metrics: metrics.commit()
+    if metrics: metrics.close()
+    return game
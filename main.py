@@ -9,107 +9,85 @@ from __future__ import annotations
 from dataclasses import dataclass
 from time import sleep, time
 from pprint import pprint
-from typing import Callable, Optional
-from copy import deepcopy
-from RestrictedPython import safe_builtins, compile_restricted
-from RestrictedPython.Eval import default_guarded_getiter
-from RestrictedPython.Guards import guarded_iter_unpack_sequence, safer_getattr
+from typing import Callable, Optional, TYPE_CHECKING
 from buildaboard import Range, PieceType, Piece, Move, Board, Clock, king, queen
+from game import Game, verify_setup, verify_move
+from metrics import Metrics
+if TYPE_CHECKING: from sandbox import Sandbox
 
-try:
-    import eel
-except ModuleNotFoundError:
-    print("Please install the module 'eel'!")
-    print('python3 -m pip install eel')
-    exit()
+# eel is only loaded once the GUI is started, and the sandbox players run
+# in once a game is, so that importing this module stays cheap and worker
+# processes never start the GUI; see start.
+eel = None
+exposed = []
+
+def expose(function):
+    exposed.append(function)
+    return function
 
 files, ranks = 'abcdefgh', '12345678'
 
 @dataclass
-class GameSituation:
-    board: Board
-    clock: Clock
+class GameSituation(Game):
     players: [Players] = None
 
+    def end(self, winner, reason):
+        # Players would otherwise go on pondering once the game is over.
+        if self.players:
+            for player in (self.players.white, self.players.black):
+                if player.sandbox: player.sandbox.stop()
+        return super().end(winner, reason)
+
 @dataclass
 class Player:
     p_setup: Callable
     p_move: Optional[Callable]
+    sandbox: Optional[Sandbox] = None
 
     def setup(self):
-        return self.verify_setup(self.p_setup())
-        try: pass
-        except Exception as e:
-            return eel.fuck('Python error in custom code: ' + str(e))
-
-    def move(self, board, clock):
         try:
-            return self.verify_move(self.p_move(deepcopy(board), deepcopy(clock)), board)
+            return self.verify_setup(self.p_setup())
         except Exception as e:
-            return eel.fuck('Python error in custom code: ' + str(e))
+            eel.fuck('Python error in custom code: ' + str(e))
+            return []
 
     def verify_setup(self, setup):
-        if any(p.rank > 2 for p in setup):
-            eel.fuck('Somebody attempted to put a place further than the first three ranks on setup. That\'s invalid!')
-            return []
-        elif sum(p.type.price for p in setup if p.type != king) > 200:
-            eel.fuck('Somebody attempted to put more than 200 points of pieces! That\'s invalid.')
-            return []
-        elif not any(p.type == king for p in setup):
-            eel.fuck('Somebody did not put a king in their initial configuration!')
+        if error := verify_setup(setup):
+            eel.fuck(error)
             return []
         return setup
 
     def verify_move(self, move, board):
         if not move: return None
-        if not any((p.rank, p.file, p.type) == (move.piece.rank, move.piece.file, move.piece.type) for p in board.player):
-            eel.fuck('Invalid move: piece to be moved does not exist / not in the right position')
-            return None
-        if not board.check_move(move):
-            eel.fuck('Invalid move attempted')
+        if error := verify_move(move, board):
+            eel.fuck(error)
             return None
         return move
 
+    def close(self):
+        if self.sandbox: self.sandbox.close()
+
     @staticmethod
     def fromText(name, info):
-        if name == 'Human':
-            try:
-                exec(info)
-            except Exception as e:
-                return eel.fuck('Python error in custom code: ' + str(e))
-            if not 'setup' in locals():
-                return eel.fuck('No setup function defined in custom code!')
-            return Player(locals()['setup'], None)
-
         if name == 'Builtin AI':
             info = open('builtin_ai2.py').read()
 
-        def run_this(function, globalv):
-            return lambda *a: eval(function + '(*a)', globalv, {'a': a})
-
+        # Player code, human setups included, is checked and runs in a worker
+        # process of its own; see sandbox.py.
+        from sandbox import Sandbox
         try:
-            binary = compile_restricted(info, filename="<player code>", mode='exec')
-            globalv, localv = {'__builtins__': safe_builtins}, {}
-            globalv['__builtins__']['__import__'] = __import__
-            globalv['__builtins__']['print'] = print
-            globalv['__builtins__']['any'] = any
-            globalv['__builtins__']['max'] = max
-            globalv['__builtins__']['min'] = min
-            globalv['__builtins__']['__metaclass__'] = type
-            globalv['__builtins__']['__name__'] = 'playercode'
-            globalv['__builtins__']['_getiter_'] = default_guarded_getiter
-            globalv['__builtins__']['_iter_unpack_sequence_'] = guarded_iter_unpack_sequence
-            globalv['__builtins__']['getattr'] = safer_getattr
-            globalv['__builtins__']['list'] = list
-            exec(info, globalv, localv)
-            globalv.update(localv)
+            sandbox = Sandbox(info, wait=eel and eel.sleep)
         except Exception as e:
             return eel.fuck('Python error in custom code: ' + str(e))
-        if not 'setup' in globalv:
+        if not 'setup' in sandbox.entry_points:
+            sandbox.close()
             return eel.fuck('No setup function defined in custom code!')
-        if not 'move' in globalv:
+        if name == 'Human':
+            return Player(sandbox.setup, None, sandbox)
+        if not 'move' in sandbox.entry_points:
+            sandbox.close()
             return eel.fuck('No move function defined in custom code!')
-        return Player(run_this('setup', globalv), run_this('move', globalv))
+        return Player(sandbox.setup, sandbox.move, sandbox)
 
 @dataclass
 class Players:
@@ -117,30 +95,57 @@ class Players:
     black: Player
 
     def move(self, board):
-        move = None
+        # Players think in a greenlet of their own, so that the frontend
+        # stays responsive, and hand their move to moveDone when it comes.
         gs.clock.last_move_start_time = time()
-        if board.player_turn and self.white.p_move:
-            move = self.white.move(board, gs.clock)
-            if not move:
-                eel.pySetMoves({})
-                return eel.fuck('White lost!')
-        elif not board.player_turn and self.black.p_move:
-            move = self.black.move(board.flipped, gs.clock.flipped)
-            if not move:
-                eel.pySetMoves({})
-                return eel.fuck('Black lost!')
-            if move: move = move.flipped
-        if move:
-            source = files[move.piece.file] + ranks[move.piece.rank]
-            target = files[move.file] + ranks[move.rank]
-            eel.receiveMove(source + '-' + target)
-            moveDone(source, target)
+        if (self.white if board.player_turn else self.black).p_move:
+            eel.spawn(self.think, board)
+
+    def think(self, board):
+        turn = board.player_turn
+        player, name = (self.white, 'White') if turn else (self.black, 'Black')
+        metrics = gs.metrics
+        move = error = None
+        timed_out = False
+        try:
+            with metrics.timed('snapshot'):
+                board = board.snapshot() if turn else board.snapshot().flipped
+                clock = gs.clock.snapshot() if turn else gs.clock.snapshot().flipped
+            with metrics.timed('engine'): move = player.p_move(board, clock)
+            if player.sandbox and player.sandbox.stats: metrics.note(engine=player.sandbox.stats)
+            with metrics.timed('validation'): move = player.verify_move(move, board)
+        except TimeoutError:
+            timed_out = True
+        except Exception as e:
+            error = 'Python error in custom code: ' + str(e)
+
+        # A new game may have been started while this player was thinking.
+        if gs.players is not self: return
+        if timed_out:
+            # The player's worker was stopped as soon as its time ran out.
+            clearMoves()
+            return eel.fuck(gs.end(not turn, name + ' lost on time!'))
+        if error: eel.fuck(error)
+        if not move:
+            clearMoves()
+            return eel.fuck(gs.end(not turn, name + ' lost!'))
+        if not turn: move = move.flipped
+        source = files[move.piece.file] + ranks[move.piece.rank]
+        target = files[move.file] + ranks[move.rank]
+        with metrics.timed('push'): eel.receiveMove(source + '-' + target)
+        moveDone(source, target)
 
 correspondingPieces = {queen: 'Q', king: 'K'}
 
-gs = GameSituation(Board([], [], None), Clock(0, 0, 0, 10, 1))
+gs = GameSituation(Board([], [], None), Clock(0, 0, 0, 10, 1), metrics=Metrics())
+
+# The moves the frontend knows of, by square, so that only what changes
+# after a move has to be sent over.
+sentMoves = {}
 
 def setup():
+    gs.winner = gs.result = None
+    gs.board.legal.clear()
     gs.board.player_turn = False
     gs.board.player = gs.players.white.setup()
     gs.board.opponent = [p.flipped for p in gs.players.black.setup()]
@@ -150,74 +155,105 @@ def setup():
     correspondingPieces.update({a: b for a, b in zip(whiteTypes, 'NBR')})
     correspondingPieces.update({a: b for a, b in zip(blackTypes, 'NBR')})
 
-@eel.expose
-def newGame(playera, playerb, infoa, infob):
+@expose
+def newGame(playera, playerb, infoa, infob, profile=False):
     white = Player.fromText(playera, infoa)
     black = Player.fromText(playerb, infob)
     if not isinstance(white, Player) or not isinstance(black, Player): return
+    if gs.players:
+        gs.players.white.close()
+        gs.players.black.close()
     gs.players = Players(white, black)
+    # With profile set, this game's moves are profiled in the players'
+    # workers and in the host; see profileReport.
+    gs.metrics = Metrics(profile=profile)
+    if profile:
+        for player in (white, black):
+            if player.p_move: player.sandbox.profile(True)
     setup()
     gs.clock.opponent_time = gs.clock.time = gs.clock.total_time
     setGamePosition()
     gs.players.move(gs.board)
 
-@eel.expose
+def allMoves(board):
+    # Moves of every piece, whichever side is to move: the frontend only
+    # lets the side to move play, so that they stay valid across turns.
+    return {files[piece.file] + ranks[piece.rank]: [files[file] + ranks[rank]
+            for rank, file in board.legal_moves(piece)] for piece in board.pieces}
+
+def turn(board): return 'w' if board.player_turn else 'b'
+
+def clearMoves():
+    sentMoves.clear()
+    eel.pySetMoves({})
+
+def pushMoves(board, pieces):
+    # Sends the moves added and removed since the last push, and the
+    # pieces that changed other than by the move the frontend was shown.
+    moves = allMoves(board)
+    added = {square: [t for t in targets if t not in sentMoves.get(square, ())]
+             for square, targets in moves.items()}
+    removed = {square: [t for t in targets if t not in moves.get(square, ())]
+               for square, targets in sentMoves.items()}
+    sentMoves.clear()
+    sentMoves.update(moves)
+    eel.pyUpdate({'turn': turn(board), 'pieces': pieces,
+                  'added': {square: targets for square, targets in added.items() if targets},
+                  'removed': {square: targets for square, targets in removed.items() if targets}})
+
+@expose
 def setGamePosition():
+    sentMoves.clear()
+    sentMoves.update(allMoves(gs.board))
     eel.pySetPosition({
             files[piece.file] + ranks[piece.rank]: 'w' + correspondingPieces[piece.type]
             for piece in gs.board.player
         } | {
             files[piece.file] + ranks[piece.rank]: 'b' + correspondingPieces[piece.type]
             for piece in gs.board.opponent
-        }, gs.board.all_valid_moves)
+        }, sentMoves, turn(gs.board))
 
-@eel.expose
+@expose
 def moveDone(source, target):
-    file, rank = files.index(source[0]), ranks.index(source[1])
-    target_file, target_rank = files.index(target[0]), ranks.index(target[1])
-    board = gs.board
-
-    # Updates the clock
-    gs.clock.plys += 1
-    if board.player_turn:
-        gs.clock.time -= time() - gs.clock.last_move_start_time
-        if gs.clock.time < 0:
-            eel.pySetMoves({})
-            return eel.fuck('White lost on time!')
-        gs.clock.time += gs.clock.increment
-    else:
-        gs.clock.opponent_time -= time() - gs.clock.last_move_start_time
-        if gs.clock.opponent_time < 0:
-            eel.pySetMoves({})
-            return eel.fuck('Black lost on time!')
-        gs.clock.opponent_time += gs.clock.increment
-
-    # Updates the board
-    for piece in board.pieces:
-        if piece.file == target_file and piece.rank == target_rank:
-            if piece.type == king:
-                eel.pySetMoves({})
-                if piece in board.opponent:
-                    return eel.fuck('Black lost their king! Game over.')
-                else: return eel.fuck('White lost their king! Game over.')
-            if piece in board.opponent: board.opponent.remove(piece)
-            else: board.player.remove(piece)
-    for piece in board.pieces:
-        if piece.file == file and piece.rank == rank:
-            piece.file, piece.rank = target_file, target_rank
-            if ((board.player_turn and piece.rank == 7) or
-                (not board.player_turn and piece.rank == 0)) and \
-                    piece.type != king:
-                piece.type = queen
-                setGamePosition()
-            board.player_turn = not board.player_turn
-            eel.pySetMoves(board.all_valid_moves)
-            break
+    board, metrics = gs.board, gs.metrics
+    with metrics.profiled():
+        reason = gs.move_done(source, target)
+        if reason: clearMoves()
+        elif gs.last_move:
+            piece, _, _, old_type, _, _ = gs.last_move
+            pieces = {}
+            if piece.type != old_type:
+                pieces[target] = ('w' if piece in board.player else 'b') + correspondingPieces[piece.type]
+            with metrics.timed('push'): pushMoves(board, pieces)
+    eel.pyMetrics(metrics.commit())
+    if reason: return eel.fuck(reason)
 
     # Triggers following move
     gs.players.move(board)
 
+@expose
+def profileReport():
+    # The profiles of the current game so far, if it was started with
+    # profiling on. The player who is thinking is left out.
+    report = {'host': gs.metrics.profile()}
+    thinking = None if gs.result else gs.board.player_turn
+    for name, turn, player in (('white', True, gs.players.white), ('black', False, gs.players.black)):
+        if gs.metrics.profiler and player.p_move and player.sandbox.process and turn != thinking:
+            report[name] = player.sandbox.profile(True)
+    return report
+
 
-eel.init('web')
-eel.start('index.html', size=(1280, 720))
+def start():
+    global eel
+    try:
+        import eel
+    except ModuleNotFoundError:
+        print("Please install the module 'eel'!")
+        print('python3 -m pip install eel')
+        exit()
+    for function in exposed: eel.expose(function)
+    eel.init('web')
+    eel.start('index.html', size=(1280, 720))
 
+if __name__ == '__main__':
+    start()
@@ -0,0 +1,63 @@
+import io
+import json
+import os
+from contextlib import contextmanager
+from time import perf_counter
+
+# cProfile and pstats are only imported once something is profiled.
+def profileReport(profiler, limit=30) -> str:
+    import pstats
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+class Metrics:
+    # What happened during one game, ply by ply: how long the host spent on
+    # each of its steps, what the clock said, and whatever the engine put in
+    # its stats. Every finished ply is written as a JSON line to output, if
+    # given. With profile set, the code run under profiled is also profiled,
+    # and the profile is dumped next to output when the game is closed.
+
+    def __init__(self, output=None, profile=False, **tags):
+        self.tags = tags
+        self.ply = {}
+        self.output = output
+        self.file = open(output, 'a') if output else None
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    def note(self, **values): self.ply.update(values)
+
+    @contextmanager
+    def timed(self, name):
+        start = perf_counter()
+        try: yield
+        finally:
+            timings = self.ply.setdefault('timings', {})
+            timings[name] = timings.get(name, 0) + perf_counter() - start
+
+    @contextmanager
+    def profiled(self):
+        if self.profiler: self.profiler.enable()
+        try: yield
+        finally:
+            if self.profiler: self.profiler.disable()
+
+    def commit(self) -> dict:
+        line, self.ply = dict(self.tags, **self.ply), {}
+        if self.file:
+            self.file.write(json.dumps(line, separators=(',', ':'), default=str) + '\n')
+            self.file.flush()
+        return line
+
+    def profile(self, limit=30) -> str:
+        return profileReport(self.profiler, limit) if self.profiler else ''
+
+    def close(self):
+        if self.ply: self.commit()
+        if self.file:
+            self.file.close()
+            self.file = None
+            if self.profiler: self.profiler.dump_stats(os.path.splitext(self.output)[0] + '.prof')
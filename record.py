@@ -0,0 +1,136 @@
+import mmap
+import struct
+from dataclasses import astuple
+from typing import Optional
+from buildaboard import Range, PieceType, Piece, Board, Clock, queen
+
+# A board is encoded as its table of piece types, one byte for how many
+# there are and 16 signed bytes of attack and movement ranges for each,
+# followed by a byte for the side to move, a byte for the number of pieces
+# and two bytes per piece: side << 6 | square, then the index of its type.
+# Opponent pieces keep their flipped types, as on the Board itself.
+rangesFormat = struct.Struct('<16b')
+clockFormat = struct.Struct('<I4f')
+
+def encodeBoard(board: Board, types=()) -> bytes:
+    types = list(dict.fromkeys([*types, *(p.type for p in board.pieces)]))
+    index = {type: i for i, type in enumerate(types)}
+    data = bytearray([len(types)])
+    for type in types: data += rangesFormat.pack(*astuple(type.attack), *astuple(type.movement))
+    data += bytes([board.player_turn, len(board.pieces)])
+    for side, pieces in ((0, board.opponent), (1, board.player)):
+        for piece in pieces:
+            data += bytes([side << 6 | piece.rank * 8 + piece.file, index[piece.type]])
+    return bytes(data)
+
+def readBoard(data, offset=0):
+    # Decodes a board starting at offset; returns it with the offset just
+    # past it.
+    types = []
+    for _ in range(data[offset]):
+        ranges = rangesFormat.unpack_from(data, offset + 1 + len(types) * 16)
+        types.append(PieceType(Range(*ranges[:8]), Range(*ranges[8:])))
+    offset += 1 + len(types) * 16
+    board = Board([], [], bool(data[offset]))
+    for i in range(data[offset + 1]):
+        square, type = data[offset + 2 + 2 * i], data[offset + 3 + 2 * i]
+        piece = Piece(types[type], (square & 63) >> 3, square & 7)
+        (board.player if square >> 6 else board.opponent).append(piece)
+    return board, offset + 2 + 2 * data[offset + 1]
+
+def decodeBoard(data) -> Board: return readBoard(data)[0]
+
+def encodeClock(clock: Clock) -> bytes:
+    return clockFormat.pack(clock.plys, clock.time, clock.opponent_time,
+                            clock.total_time, clock.increment)
+
+def decodeClock(data, offset=0) -> Clock: return Clock(*clockFormat.unpack_from(data, offset))
+
+
+# A game record is a header, the initial board and clock padded to a
+# multiple of eight bytes, then one eight-byte record per ply: 'M', the
+# source and target squares, a spare byte and the time the mover had left.
+# A finished game ends with an 'E' record holding the winner (1 for white,
+# 0 for black, 2 for neither) and the length of the reason that follows.
+# Plies are fixed-size, so any one of them is found without reading the
+# ones before it, and a record cut short by a crash is still readable.
+magic = b'BAB1'
+moveFormat = struct.Struct('<cBBxf')
+endFormat = struct.Struct('<cBxxI')
+# The file holds no boards past the first one, so Record keeps an encoded
+# board every snapshotInterval plies it replays through. The first seek to
+# a ply still replays every ply before it; later ones near it, as when
+# stepping through a game, start from the last snapshot before them.
+snapshotInterval = 32
+
+class RecordWriter:
+
+    def __init__(self, path: str, board: Board, clock: Clock):
+        header = magic + encodeBoard(board, [queen]) + encodeClock(clock)
+        self.file = open(path, 'wb')
+        self.file.write(header + bytes(-len(header) % 8))
+        self.file.flush()
+
+    def move(self, source: int, target: int, time_left: float):
+        self.file.write(moveFormat.pack(b'M', source, target, time_left))
+        self.file.flush()
+
+    def end(self, winner: Optional[bool], reason: str):
+        reason = reason.encode()
+        self.file.write(endFormat.pack(b'E', {True: 1, False: 0, None: 2}[winner], len(reason)) + reason)
+        self.file.close()
+
+class Record:
+    # Reads a game record through a memory map.
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.data[:4] == magic, 'Not a game record'
+        self.board, offset = readBoard(self.data, 4)
+        self.snapshots = {0: encodeBoard(self.board)}
+        self.clock = decodeClock(self.data, offset)
+        self.start = offset + clockFormat.size + (-(offset + clockFormat.size) % 8)
+        # The tags of all plies are one slice apart.
+        complete = (len(self.data) - self.start) // 8
+        tags = self.data[self.start:self.start + complete * 8:8]
+        self.plys = tags.find(b'E') if b'E' in tags else complete
+        self.winner = self.reason = None
+        self.finished = self.plys < complete
+        if self.finished:
+            offset = self.start + self.plys * 8
+            _, winner, length = endFormat.unpack_from(self.data, offset)
+            self.winner = {1: True, 0: False, 2: None}[winner]
+            self.reason = self.data[offset + 8:offset + 8 + length].decode()
+
+    def move(self, ply: int):
+        # Source square, target square and time the mover had left.
+        assert 0 <= ply < self.plys, 'No such ply'
+        _, source, target, time_left = moveFormat.unpack_from(self.data, self.start + ply * 8)
+        return source, target, time_left
+
+    def replay(self, ply: Optional[int] = None, first: int = 0):
+        # Yields the board before every ply from first up to the given one
+        # and after the last of them, updating the same board in place.
+        # Plies before first are only played from the nearest snapshot.
+        last = self.plys if ply is None else ply
+        base = first - first % snapshotInterval
+        while base not in self.snapshots: base -= snapshotInterval
+        board = decodeBoard(self.snapshots[base])
+        for i in range(base, last):
+            if i % snapshotInterval == 0 and i not in self.snapshots: self.snapshots[i] = encodeBoard(board)
+            if i >= first: yield board
+            source, target, _ = self.move(i)
+            for piece in board.pieces:
+                if piece.rank * 8 + piece.file == source:
+                    board.make_move((piece, target >> 3, target & 7))
+                    break
+        yield board
+
+    def seek(self, ply: int) -> Board:
+        # The board before the given ply, played from the nearest snapshot
+        # before it; see snapshotInterval.
+        for board in self.replay(ply, ply): pass
+        return board
+
+    def close(self): self.data.close()
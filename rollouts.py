@@ -0,0 +1,117 @@
+import numpy as np
+from buildaboard import Board, king, queen, directions, dirToCoordDelta, withinBoard
+
+# Square, direction and distance - 1 to target square; 64 is off the board.
+targets = np.full((64, 8, 8), 64)
+for square in range(64):
+    for k, prop in enumerate(directions):
+        for i in range(8):
+            rank = square // 8 + dirToCoordDelta[prop][1] * (i + 1)
+            file = square % 8 + dirToCoordDelta[prop][0] * (i + 1)
+            if withinBoard(rank, file): targets[square, k, i] = rank * 8 + file
+
+class Rollouts:
+    # Random playouts of one position, advanced together one ply at a time.
+    # Each playout is a row of 65 cells: 0 for an empty square, t + 1 for a
+    # player piece of the t-th type and -(t + 1) for an opponent one. The
+    # 65th cell stands for every square off the board.
+
+    def __init__(self, board: Board, king_value: int):
+        self.types = list(dict.fromkeys([p.type for p in board.pieces] + [queen]))
+        self.queen = self.types.index(queen) + 1
+        self.king_value = king_value
+        self.side = 1 if board.player_turn else -1
+        self.start = np.zeros(65, dtype=np.int8)
+        self.start[64] = 127
+        for piece in board.player:
+            self.start[piece.rank * 8 + piece.file] = self.types.index(piece.type) + 1
+        for piece in board.opponent:
+            self.start[piece.rank * 8 + piece.file] = -self.types.index(piece.type) - 1
+
+        # Indexed by the absolute value of a cell.
+        distance = np.arange(1, 9)
+        self.is_king = np.array([False] + [t == king for t in self.types])
+        self.movement = np.zeros((len(self.types) + 1, 8, 8), dtype=bool)
+        self.attack = np.zeros((len(self.types) + 1, 8, 8), dtype=bool)
+        for t, type in enumerate(self.types, 1):
+            self.movement[t] = distance <= np.array(type.movement_limits)[:, None]
+            self.attack[t] = distance <= np.array(type.attack_limits)[:, None]
+        self.reach = (self.movement | self.attack).sum(2).max(1)
+
+        # eval_b of every cell value on every square, from the point of
+        # view of the player (index 0) and of the opponent (index 1).
+        offset = len(self.types)
+        self.values = np.zeros((2, 2 * offset + 1, 64), dtype=np.int64)
+        for t, type in enumerate(self.types, 1):
+            prices = {1: type.price, -1: type.flipped.price}
+            for square in range(64):
+                for owner, perspective in ((1, 0), (1, 1), (-1, 0), (-1, 1)):
+                    rank = square // 8 if owner == 1 else 7 - square // 8
+                    price = prices[owner]
+                    if type == king: value = king_value - rank
+                    else: value = price + rank
+                    if (owner == 1) != (perspective == 0):
+                        value = -king_value + 7 - rank if type == king else -price - rank
+                    self.values[perspective, offset + owner * t, square] = value
+
+    def evaluate(self, cells, side):
+        squares = cells[:, :64].astype(np.int64) + len(self.types)
+        return self.values[0 if side == 1 else 1, squares, np.arange(64)].sum(1)
+
+    def legal(self, cells, side):
+        # Only squares holding a piece of the side to move in some row, and
+        # distances some of those pieces can reach, are looked at. Returns
+        # the squares, the reach and, for every row, a flat mask of
+        # (square, direction, distance) moves.
+        mine = cells[:, :64] * side > 0
+        squares = np.flatnonzero(mine.any(0))
+        types = np.abs(cells[:, squares])
+        reach = max(int(self.reach[types].max(initial=0)), 1)
+        rays = targets[squares, :, :reach]
+        occupants = cells[:, rays]
+        occupied = occupants != 0
+        clear = np.ones_like(occupied)
+        for i in range(1, reach):
+            clear[..., i] = clear[..., i - 1] & ~occupied[..., i - 1]
+        enemy = (occupants.astype(np.int16) * side < 0) & (rays != 64)
+        allowed = (self.movement[types, :, :reach] & ~occupied) | \
+            (self.attack[types, :, :reach] & enemy)
+        legal = mine[:, squares, None, None] & clear & allowed
+        return squares, reach, legal.reshape(len(cells), -1)
+
+    def run(self, depths, rng):
+        # Plays one row per entry of depths, each for that many plies, and
+        # returns their scores as builtin_ai3.play would, negated, that is
+        # from the point of view of the side that moved into the position.
+        cells = np.repeat(self.start[None], len(depths), axis=0)
+        results = np.zeros(len(depths), dtype=np.int64)
+        active = np.ones(len(depths), dtype=bool)
+        side, sign = self.side, -1
+        for ply in range(depths.max() + 1):
+            rows = np.flatnonzero(active & (depths == ply))
+            results[rows] = sign * self.evaluate(cells[rows], side)
+            active[rows] = False
+
+            rows = np.flatnonzero(active)
+            if not len(rows): break
+            mine = cells[rows, :64] * side > 0
+            kings = (self.is_king[np.abs(cells[rows, :64])] & mine).any(1)
+            squares, reach, legal = self.legal(cells[rows], side)
+            counts = legal.sum(1)
+            lost = ~kings | (counts == 0)
+            results[rows[lost]] = -sign * self.king_value
+            active[rows[lost]] = False
+
+            rows, legal, counts = rows[~lost], legal[~lost], counts[~lost]
+            if not len(rows): break
+            picks = (rng.random(len(rows)) * counts).astype(np.int64)
+            moves = (np.cumsum(legal, 1, dtype=np.int16) > picks[:, None]).argmax(1)
+            sources = squares[moves // (8 * reach)]
+            destinations = targets[sources, moves // reach % 8, moves % reach]
+            pieces = cells[rows, sources]
+            promoted = ~self.is_king[np.abs(pieces)] & \
+                (destinations // 8 == (7 if side == 1 else 0))
+            cells[rows, destinations] = np.where(promoted, side * self.queen, pieces)
+            cells[rows, sources] = 0
+            side, sign = -side, -sign
+        return results
@@ -0,0 +1,204 @@
+import atexit
+import marshal
+import os
+import signal
+import sys
+import threading
+import weakref
+from dataclasses import astuple
+from hashlib import sha256
+from multiprocessing import Pipe, Process, util
+from time import sleep, time
+from RestrictedPython import safe_builtins, compile_restricted
+from RestrictedPython.Eval import default_guarded_getiter
+from RestrictedPython.Guards import guarded_iter_unpack_sequence, safer_getattr
+from buildaboard import Range, PieceType, Piece, FrozenPiece, Move, BoardSnapshot, ClockSnapshot, pieceTypes
+from metrics import profileReport
+
+# Player code, compiled once by hash of its source, and kept both here and
+# in cache_directory, so that later games and runs skip compiling it. All
+# of it, human setups as well as engines, has to pass RestrictedPython's
+# checks, then runs as plain Python in a worker, with playerBuiltins only.
+compiled = {}
+cache_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
+
+def compileCode(source: str) -> bytes:
+    key = sha256(source.encode()).hexdigest()
+    if key in compiled: return compiled[key]
+    # marshal's format changes between Python versions.
+    path = cache_directory and os.path.join(cache_directory, f'player-{key[:32]}.{sys.implementation.cache_tag}.bin')
+    if path and os.path.exists(path):
+        with open(path, 'rb') as file: compiled[key] = file.read()
+        return compiled[key]
+    compile_restricted(source, filename='<player code>', mode='exec')
+    compiled[key] = marshal.dumps(compile(source, '<player code>', 'exec'))
+    if path:
+        try:
+            os.makedirs(cache_directory, exist_ok=True)
+            with open(path + f'.{os.getpid()}', 'wb') as file: file.write(compiled[key])
+            os.replace(path + f'.{os.getpid()}', path)
+        except OSError: pass
+    return compiled[key]
+
+def playerBuiltins():
+    builtins = dict(safe_builtins)
+    builtins.update({
+        '__import__': __import__, 'print': print, 'any': any, 'max': max, 'min': min,
+        '__metaclass__': type, '__name__': 'playercode', 'list': list,
+        '_getiter_': default_guarded_getiter, 'getattr': safer_getattr,
+        '_iter_unpack_sequence_': guarded_iter_unpack_sequence,
+    })
+    return builtins
+
+# Boards cross the process boundary as tuples of ints, type id << 6 | square,
+# with the ranges of piece types the worker has not seen yet sent along.
+# Moves come back as source square << 6 | target square, along with a copy
+# of the player's stats dict, if it keeps one.
+def encodeType(type: PieceType): return astuple(type.attack), astuple(type.movement)
+def decodeType(encoded) -> PieceType: return PieceType(Range(*encoded[0]), Range(*encoded[1]))
+def encodePieces(pieces): return tuple(p.type.id << 6 | p.rank * 8 + p.file for p in pieces)
+
+def watchHost(host_pid):
+    # Kills the worker, along with its process group, once the host is gone,
+    # however it went: it may never get to close its sandboxes.
+    while os.getppid() == host_pid: sleep(.5)
+    try: os.killpg(0, signal.SIGKILL)
+    except (AttributeError, OSError): os._exit(1)
+
+def serve(connection, host, host_pid):
+    # The worker side: runs one player's code, request by request. Its own
+    # process group holds any processes the player starts, so that they are
+    # stopped along with it. The host's end of the pipe is closed here, so
+    # that the worker returns once the host is gone while it waits for a
+    # request; watchHost sees to it while player code is running.
+    if hasattr(os, 'setpgrp'): os.setpgrp()
+    host.close()
+    threading.Thread(target=watchHost, args=(host_pid,), daemon=True).start()
+    namespace, types, profiler = {}, [], None
+    decode = lambda pieces: [FrozenPiece(types[p >> 6], p >> 3 & 7, p & 7) for p in pieces]
+    while True:
+        try: request, *args = connection.recv()
+        except EOFError: return
+        move = None
+        try:
+            if request == 'load':
+                namespace = {'__builtins__': playerBuiltins()}
+                exec(marshal.loads(args[0]), namespace)
+                reply = [name for name in ('setup', 'move') if name in namespace]
+            elif request == 'setup':
+                reply = [(encodeType(p.type), p.rank, p.file) for p in namespace['setup']()]
+            elif request == 'move':
+                new_types, player_turn, opponent, player, clock = args
+                types.extend(decodeType(t) for t in new_types)
+                board = BoardSnapshot(decode(opponent), decode(player), player_turn)
+                clock = ClockSnapshot(*clock)
+                if profiler: profiler.enable()
+                try: move = namespace['move'](board, clock)
+                finally:
+                    if profiler: profiler.disable()
+                stats = namespace.get('stats')
+                reply = (move and (move.piece.rank * 8 + move.piece.file) << 6 | move.rank * 8 + move.file,
+                         dict(stats) if isinstance(stats, dict) else None)
+            elif request == 'stop':
+                # Only there to interrupt pondering.
+                reply = None
+            elif request == 'profile':
+                # Reports on the moves profiled so far, and goes on
+                # profiling them or stops.
+                reply = profileReport(profiler) if profiler else ''
+                import cProfile
+                profiler = (profiler or cProfile.Profile()) if args[0] else None
+            connection.send((True, reply))
+        except Exception as e:
+            connection.send((False, str(e)))
+        # Players may go on thinking on the opponent's time, until the host
+        # sends its next request.
+        if move and 'ponder' in namespace:
+            try: namespace['ponder'](board, move, clock, connection.poll)
+            except Exception: pass
+
+# Workers are not daemons, so that players can start processes of their
+# own, as the engines' parallel search does; they are closed at exit instead,
+# before multiprocessing's own exit handler, imported above, waits for them.
+# A host that dies before it gets there is left to watchHost.
+sandboxes = weakref.WeakSet()
+
+@atexit.register
+def closeAll():
+    for sandbox in list(sandboxes): sandbox.close()
+
+class Sandbox:
+    # A player's code in a worker process of its own, kept alive across
+    # moves. A move that takes longer than the time left on the clock is
+    # cut short by killing the worker, and raises TimeoutError. Given a wait
+    # function, such as eel.sleep, calls wait with it in short steps instead
+    # of blocking until the reply comes.
+
+    def __init__(self, source: str, wait=None):
+        self.code = compileCode(source)
+        self.wait = wait
+        self.process = None
+        self.stats = None
+        self.start()
+
+    def start(self):
+        self.connection, child = Pipe()
+        self.process = Process(target=serve, args=(child, self.connection, os.getpid()))
+        self.process.start()
+        child.close()
+        sandboxes.add(self)
+        self.sent_types = 0
+        self.entry_points = self.call(None, 'load', self.code)
+
+    def close(self):
+        if self.process is not None:
+            try: os.killpg(self.process.pid, signal.SIGKILL)
+            except (AttributeError, OSError): self.process.kill()
+            self.process.join()
+            self.connection.close()
+        self.process = None
+
+    def call(self, timeout, *request):
+        if self.process is None: self.start()
+        self.connection.send(request)
+        deadline = None if timeout is None else time() + timeout
+        try:
+            while self.wait and not self.connection.poll():
+                if deadline is not None and time() > deadline: break
+                self.wait(.01)
+                if self.process is None: raise RuntimeError('Player was stopped')
+            left = None if deadline is None else max(deadline - time(), 0)
+            if not self.connection.poll(left):
+                self.close()
+                raise TimeoutError('Player ran out of time')
+            ok, reply = self.connection.recv()
+        except EOFError:
+            self.close()
+            raise RuntimeError('Player process died')
+        if not ok: raise RuntimeError(reply)
+        return reply
+
+    def stop(self):
+        # Stops the player pondering, without starting a worker that is gone.
+        if self.process is not None: self.call(None, 'stop')
+
+    def profile(self, enabled: bool) -> str:
+        return self.call(None, 'profile', enabled)
+
+    def setup(self):
+        return [Piece(decodeType(type), rank, file) for type, rank, file in self.call(None, 'setup')]
+
+    def move(self, board, clock):
+        if self.process is None: self.start()
+        types = [encodeType(type) for type in pieceTypes[self.sent_types:]]
+        self.sent_types += len(types)
+        packed, self.stats = self.call(max(clock.time, 0), 'move', types, board.player_turn,
+                                       encodePieces(board.opponent), encodePieces(board.player),
+                                       (clock.plys, clock.time, clock.opponent_time,
+                                        clock.total_time, clock.increment, clock.last_move_start_time))
+        if not packed: return None
+        source, rank, file = packed >> 6, (packed & 63) >> 3, packed & 7
+        for piece in board.player:
+            if piece.rank * 8 + piece.file == source: return Move(piece, rank, file)
+        # Left for verify_move to reject.
+        return Move(FrozenPiece(None, source >> 3, source & 7), rank, file)
@@ -0,0 +1,145 @@
+"""
+Plays builtin_ai2 against itself across processes and streams every
+searched position to disk, for tune.py to fit evaluation weights on:
+
+    python3 selfplay.py positions --games 10000 --workers 8
+
+Positions are written in chunks of about --chunk records, as .npz files.
+The directory also keeps how many games are in them, so an interrupted
+run picks up after the last chunk written; every game is seeded by its
+index, so the data comes out the same either way. Only a batch of games
+is ever in memory, however long the run.
+"""
+
+import json
+import os
+import random
+from argparse import ArgumentParser
+from dataclasses import astuple
+from multiprocessing import Pool
+import numpy as np
+from buildaboard import king, Move
+from game import play
+from record import encodeBoard
+import builtin_ai2
+
+# Features of a position, from the point of view of the side to move: for
+# it, then for the other side, the number of pieces other than kings, the
+# sums of their attack ranges and of their movement ranges by direction,
+# in the order of Range's fields, the sum of their ranks, then the number
+# of kings and the sum of their ranks. Types and ranks are seen from each
+# piece's owner, as pieceTerms does, so evaluate is linear in them.
+sideFeatures = 20
+featureCount = 2 * sideFeatures
+
+def features(board) -> list:
+    values = [0] * featureCount
+    for offset, pieces, player in ((0, board.player, True), (sideFeatures, board.opponent, False)):
+        for piece in pieces:
+            type = piece.type if player else piece.type.flipped
+            rank = piece.rank if player else 7 - piece.rank
+            if type == king:
+                values[offset + 18] += 1
+                values[offset + 19] += rank
+                continue
+            values[offset] += 1
+            for i, value in enumerate(astuple(type.attack) + astuple(type.movement)):
+                values[offset + 1 + i] += value
+            values[offset + 17] += rank
+    return values
+
+class Recorder:
+    # builtin_ai2, writing down every position it searched and the score
+    # it found for it. The first few moves of a game are random instead,
+    # so that games differ.
+
+    def __init__(self, rng, random_moves):
+        self.rng, self.random_moves = rng, random_moves
+        self.positions, self.plys = [], 0
+
+    def setup(self): return builtin_ai2.setup()
+
+    def move(self, board, clock):
+        self.plys += 1
+        if self.plys <= self.random_moves:
+            moves = [(piece, rank, file) for piece in board.player for rank, file in board.legal_moves(piece)]
+            return Move(*self.rng.choice(moves)) if moves else None
+        position = features(board), encodeBoard(board)
+        move = builtin_ai2.move(board, clock)
+        self.positions.append((*position, builtin_ai2.stats.get('score', 0)))
+        return move
+
+def playGame(task):
+    index, seed, depth, random_moves, max_plys = task
+    random.seed(seed + index)
+    rng = random.Random(seed + index)
+    builtin_ai2.max_depth = depth
+    builtin_ai2.table.clear()
+    white, black = Recorder(rng, random_moves), Recorder(rng, random_moves)
+    game = play(white, black, 10 ** 6, 0, max_plys)
+    records = []
+    for recorder, side in ((white, True), (black, False)):
+        outcome = 0 if game.winner is None else 1 if game.winner == side else -1
+        records += [(values, board, side, score, outcome) for values, board, score in recorder.positions]
+    return records
+
+def writeChunk(path, records):
+    boards = [board for _, board, _, _, _ in records]
+    data = {
+        'features': np.array([values for values, _, _, _, _ in records], dtype=np.int16).reshape(-1, featureCount),
+        'boards': np.frombuffer(b''.join(boards), dtype=np.uint8),
+        'offsets': np.cumsum([0] + [len(board) for board in boards], dtype=np.int64),
+        'white': np.array([side for _, _, side, _, _ in records], dtype=bool),
+        'score': np.array([score for _, _, _, score, _ in records], dtype=np.int32),
+        'result': np.array([outcome for _, _, _, _, outcome in records], dtype=np.int8),
+    }
+    with open(path + '.tmp', 'wb') as file: np.savez_compressed(file, **data)
+    os.replace(path + '.tmp', path)
+
+def chunks(directory):
+    # Every chunk written so far, one at a time.
+    for name in sorted(os.listdir(directory)):
+        if name.startswith('chunk-') and name.endswith('.npz'):
+            with np.load(os.path.join(directory, name)) as chunk: yield dict(chunk)
+
+def selfplay(directory, games=None, workers=None, chunk_size=50000, depth=3, random_moves=4,
+             max_plys=300, seed=0):
+    # Yields the progress after every chunk; runs forever without games.
+    os.makedirs(directory, exist_ok=True)
+    state_path = os.path.join(directory, 'progress.json')
+    state = {'games': 0, 'chunks': 0, 'records': 0}
+    if os.path.exists(state_path):
+        with open(state_path) as file: state = json.load(file)
+    settings = {'seed': seed, 'depth': depth, 'random_moves': random_moves, 'max_plys': max_plys}
+    assert state.setdefault('settings', settings) == settings, 'Resuming with different settings'
+    buffer, index = [], state['games']
+    batch = 4 * (workers or os.cpu_count())
+    with Pool(workers) as pool:
+        while games is None or index < games:
+            tasks = [(i, seed, depth, random_moves, max_plys)
+                     for i in range(index, index + batch if games is None else min(index + batch, games))]
+            for records in pool.imap(playGame, tasks):
+                buffer += records
+                index += 1
+                if len(buffer) >= chunk_size or index == games:
+                    writeChunk(os.path.join(directory, f"chunk-{state['chunks']:06d}.npz"), buffer)
+                    state.update(games=index, chunks=state['chunks'] + 1, records=state['records'] + len(buffer))
+                    with open(state_path + '.tmp', 'w') as file: json.dump(state, file)
+                    os.replace(state_path + '.tmp', state_path)
+                    buffer = []
+                    yield dict(state)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Streams self-play positions to disk.')
+    parser.add_argument('directory')
+    parser.add_argument('--games', type=int, default=None, help='games in all, or play until stopped')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk', type=int, default=50000, help='records per chunk')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--random-moves', type=int, default=4, help='random moves by each side to start with')
+    parser.add_argument('--plys', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for state in selfplay(args.directory, args.games, args.workers, args.chunk, args.depth,
+                          args.random_moves, args.plys, args.seed):
+        print(f"{state['games']} games, {state['records']} positions in {state['chunks']} chunks")
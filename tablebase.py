@@ -0,0 +1,308 @@
+"""
+Builds endgame tablebases for small sets of piece types by retrograde
+analysis:
+
+    python3 tablebase.py --pieces 3 --directory tablebases
+
+Tables cover the kings and every way of adding up to pieces - 2 of the
+types in the given setups, and queens, to either side. Every position is
+scored by whether the side to move wins, loses or can do neither, and in
+how many plies the king is captured or the loser runs out of moves.
+--verify checks tables against a brute-force search of random positions.
+"""
+
+import mmap
+import os
+import random
+from argparse import ArgumentParser
+from array import array
+from collections import OrderedDict
+from dataclasses import astuple
+from hashlib import sha256
+from importlib import import_module
+from itertools import combinations_with_replacement, product
+from buildaboard import PieceType, Piece, BitBoard, king, queen, promotes
+from record import rangesFormat
+
+# A table holds one byte per position: 0 if neither side can force a win
+# (or the position is impossible), otherwise 1 + the plies until the game
+# ends with best play. An even number of plies means the side to move
+# loses: 0 plies when it has no king or no moves.
+#
+# Positions are indexed by the side to move and the square of every piece,
+# white's then black's, each side's sorted by typeKey, so that they are the
+# same in every process. Black's types are kept flipped, as on the Board.
+magic = b'BTB1'
+
+typeKeys = []
+
+def typeKey(type: PieceType):
+    while len(typeKeys) <= type.id: typeKeys.append(None)
+    if typeKeys[type.id] is None:
+        typeKeys[type.id] = (type != king, astuple(type.attack), astuple(type.movement))
+    return typeKeys[type.id]
+
+def material(white, black):
+    return tuple(sorted(white, key=typeKey)), tuple(sorted(black, key=typeKey))
+
+def header(key) -> bytes:
+    white, black = key
+    data = bytearray(magic + bytes([len(white) + len(black)]))
+    for side, types in ((1, white), (0, black)):
+        for type in types:
+            data += bytes([side]) + rangesFormat.pack(*astuple(type.attack), *astuple(type.movement))
+    return bytes(data + bytes(-len(data) % 8))
+
+def fileName(key) -> str:
+    return f'{len(key[0]) + len(key[1])}-{sha256(header(key)).hexdigest()[:16]}.tb'
+
+def locate(white, black, turn):
+    # The material and index of a position given as (type, square) pairs.
+    white = sorted(white, key=lambda piece: typeKey(piece[0]))
+    black = sorted(black, key=lambda piece: typeKey(piece[0]))
+    index = int(turn)
+    for _, square in white + black: index = index * 64 + square
+    return (tuple(t for t, _ in white), tuple(t for t, _ in black)), index
+
+def result(code):
+    # 1 if the side to move wins, -1 if it loses, 0 otherwise, and the
+    # plies until the game ends.
+    if not code: return 0, None
+    return (1 if (code - 1) & 1 else -1), code - 1
+
+def score(code, mate=10000):
+    # A search score for the side to move: wins sooner and losses later
+    # score better, all of them beyond 9000 like a king capture.
+    outcome, plies = result(code)
+    return outcome * (mate - plies) if outcome else 0
+
+
+class Tablebases:
+    # Probes table files in a directory through memory maps, keeping the
+    # most recently used ones open. Materials without a file are kept apart,
+    # so that looking them up again neither touches the disk nor pushes
+    # open tables out.
+
+    def __init__(self, directory: str, size: int = 8):
+        self.directory, self.size = directory, size
+        self.tables, self.missing = OrderedDict(), set()
+        self.hits = 0
+        names = os.listdir(directory) if os.path.isdir(directory) else []
+        self.pieces = max((int(name.split('-')[0]) for name in names if name.endswith('.tb')), default=0)
+
+    def table(self, key):
+        if key in self.tables:
+            self.tables.move_to_end(key)
+            return self.tables[key]
+        if key in self.missing: return None
+        path = os.path.join(self.directory, fileName(key))
+        if not os.path.exists(path):
+            self.missing.add(key)
+            return None
+        with open(path, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        expected = header(key)
+        assert data[:len(expected)] == expected, f'{path} is not the table it is named after'
+        table = self.tables[key] = data, len(expected)
+        if len(self.tables) > self.size: self.tables.popitem(last=False)[1][0].close()
+        return table
+
+    def probe(self, board):
+        # The code of the position, or None if it has no table.
+        if len(board.player) + len(board.opponent) > self.pieces: return None
+        key, index = locate([(p.type, p.rank * 8 + p.file) for p in board.player],
+                            [(p.type, p.rank * 8 + p.file) for p in board.opponent], board.player_turn)
+        table = self.table(key)
+        if table is None: return None
+        self.hits += 1
+        data, offset = table
+        return data[offset + index]
+
+    def close(self):
+        for data, _ in self.tables.values(): data.close()
+        self.tables.clear()
+        self.missing.clear()
+
+
+def generate(key, tables, directory):
+    # Solves one material set, after the ones its captures and promotions
+    # lead to, and writes it. tables holds every table solved so far.
+    if key in tables: return tables[key]
+    path = os.path.join(directory, fileName(key))
+    if os.path.exists(path):
+        with open(path, 'rb') as file: tables[key] = file.read()[len(header(key)):]
+        return tables[key]
+
+    white, black = key
+    types = white + black
+    n = len(types)
+    size = 64 ** n
+    weights = [64 ** (n - 1 - i) for i in range(n)]
+    pieces = [Piece(type, 0, 0) for type in types]
+    board = BitBoard(pieces[len(white):], pieces[:len(white)], False)
+
+    # Moves within the table are kept as edges, to walk back from the
+    # positions that are solved; the ones that leave it, by a capture or a
+    # promotion, are scored right away from the tables they lead to.
+    count = bytearray(2 * size)      # moves within the table not solved yet
+    best = bytearray(2 * size)       # the quickest win found so far
+    longest = bytearray(2 * size)    # the slowest loss found so far
+    drawn = bytearray(2 * size)      # some move leaves the table for a draw
+    legal = bytearray(2 * size)
+    sources, targets = array('I'), array('I')
+
+    def leave(code, position):
+        if not code: drawn[position] = 1
+        elif (code - 1) & 1 == 0:
+            if not best[position] or code + 1 < best[position]: best[position] = code + 1
+        elif code + 1 > longest[position]: longest[position] = code + 1
+
+    for squares in product(range(64), repeat=n):
+        if len(set(squares)) < n: continue
+        # Only what generateAllowed looks at is set up, instead of syncing
+        # the whole board every time.
+        board.squares = [None] * 64
+        board.player_mask = board.opponent_mask = 0
+        for i, (piece, square) in enumerate(zip(pieces, squares)):
+            piece.rank, piece.file = square >> 3, square & 7
+            board.squares[square] = piece
+            if i < len(white): board.player_mask |= 1 << square
+            else: board.opponent_mask |= 1 << square
+        base = sum(s * w for s, w in zip(squares, weights))
+        for turn in (False, True):
+            board.player_turn = turn
+            position = turn * size + base
+            legal[position] = 1
+            movers = range(len(white)) if turn else range(len(white), n)
+            for i in movers:
+                piece = pieces[i]
+                for rank, file in board.generateAllowed(piece):
+                    target = rank * 8 + file
+                    victim = board.squares[target]
+                    if victim is not None and victim.type == king:
+                        leave(1, position)
+                    elif victim is not None or promotes(piece, rank, turn):
+                        after = [(queen if j == i and promotes(piece, rank, turn) else types[j],
+                                  target if j == i else squares[j], j < len(white))
+                                 for j in range(n) if squares[j] != target]
+                        other, index = locate([(t, s) for t, s, mine in after if mine],
+                                              [(t, s) for t, s, mine in after if not mine], not turn)
+                        leave(generate(other, tables, directory)[index], position)
+                    else:
+                        sources.append((not turn) * size + base + (target - squares[i]) * weights[i])
+                        targets.append(position)
+                        count[position] += 1
+
+    # Edges by the position they lead to.
+    starts = array('I', bytes(4 * (2 * size + 1)))
+    for source in sources: starts[source + 1] += 1
+    for position in range(2 * size): starts[position + 1] += starts[position]
+    parents, filled = array('I', bytes(4 * len(sources))), array('I', starts)
+    for source, target in zip(sources, targets):
+        parents[filled[source]] = target
+        filled[source] += 1
+    del sources, targets, filled
+
+    # Positions are solved in order of plies: wins take the quickest move
+    # to a loss, losses the slowest move to a win.
+    values = bytearray(2 * size)
+    buckets = [[] for _ in range(256)]
+    for position in range(2 * size):
+        if not legal[position]: continue
+        if best[position]: buckets[best[position]].append(position)
+        elif not count[position] and not drawn[position]:
+            buckets[longest[position] or 1].append(position)
+    for code in range(1, 256):
+        for position in buckets[code]:
+            if values[position]: continue
+            values[position] = code
+            if code == 255: raise ValueError('Game too long for a table')
+            for parent in parents[starts[position]:starts[position + 1]]:
+                if values[parent]: continue
+                if (code - 1) & 1 == 0:
+                    if not best[parent] or code + 1 < best[parent]:
+                        best[parent] = code + 1
+                        buckets[code + 1].append(parent)
+                else:
+                    count[parent] -= 1
+                    if code + 1 > longest[parent]: longest[parent] = code + 1
+                    if not count[parent] and not best[parent] and not drawn[parent]:
+                        buckets[longest[parent]].append(parent)
+
+    os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'wb') as file: file.write(header(key) + values)
+    os.replace(path + '.tmp', path)
+    tables[key] = values
+    return values
+
+def materials(types, pieces):
+    # Every material set with both kings and up to pieces - 2 others of the
+    # given types or queens, split between the sides in every way.
+    types = list(dict.fromkeys([*types, queen]))
+    for extra in range(pieces - 1):
+        for chosen in combinations_with_replacement(types, extra):
+            for split in range(extra + 1):
+                white, black = chosen[:split], chosen[split:]
+                yield material((king, *white), (king, *(t.flipped for t in black)))
+
+
+def solve(board, plies):
+    # The code of a position, found by trying every line of play up to the
+    # given number of plies; 0 if the game does not end within them.
+    if not any(p.type == king for p in board.to_move): return 1
+    moves = [(piece, rank, file) for piece in list(board.to_move)
+             for rank, file in board.generateAllowed(piece)]
+    if not moves: return 1
+    if not plies: return 0
+    codes = []
+    for move in moves:
+        undo = board.make_move(move)
+        codes.append(solve(board, plies - 1))
+        board.unmake_move(undo)
+    losses = [code for code in codes if code and (code - 1) & 1 == 0]
+    if losses: return min(losses) + 1
+    if all(codes): return max(codes) + 1
+    return 0
+
+def verify(key, tables, plies, samples, rng):
+    # Half the positions are drawn from those that end within the plies,
+    # half from all of them.
+    white, black = key
+    values = tables[key]
+    n = len(white) + len(black)
+    short = [index for index, code in enumerate(values) if code and code - 1 <= plies]
+    legal = [index for index, code in enumerate(values) if code or len(set(squaresOf(index, n))) == n]
+    for index in rng.sample(short, min(len(short), samples // 2)) + rng.sample(legal, samples - samples // 2):
+        squares = squaresOf(index, n)
+        board = BitBoard([Piece(t, s >> 3, s & 7) for t, s in zip(black, squares[len(white):])],
+                         [Piece(t, s >> 3, s & 7) for t, s in zip(white, squares)], bool(index >> 6 * n))
+        code = values[index]
+        expected = code if code and code - 1 <= plies else 0
+        assert solve(board, plies) == expected, f'{fileName(key)}: {board} is {code} in the table'
+
+def squaresOf(index, n):
+    return [index >> 6 * (n - 1 - i) & 63 for i in range(n)]
+
+def setupTypes(names):
+    types = []
+    for name in names:
+        module, function = name.rsplit('.', 1)
+        types.extend(p.type for p in getattr(import_module(module), function)() if p.type != king)
+    return list(dict.fromkeys(types))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Builds endgame tablebases by retrograde analysis.')
+    parser.add_argument('--setups', nargs='+', help='setup functions to take piece types from',
+                        default=['builtin_ai2.mixed_setup', 'builtin_ai2.pawn_setup', 'builtin_ai3.setup'])
+    parser.add_argument('--pieces', type=int, default=3, help='most pieces in a table, kings included')
+    parser.add_argument('--directory', default='tablebases')
+    parser.add_argument('--verify', type=int, default=0, metavar='PLIES',
+                        help='check random positions of every table against a search this deep')
+    parser.add_argument('--samples', type=int, default=200)
+    args = parser.parse_args()
+    tables = {}
+    for key in materials(setupTypes(args.setups), args.pieces):
+        generate(key, tables, args.directory)
+        print(fileName(key), sum(1 for code in tables[key] if code and (code - 1) & 1),
+              'wins, longest', max(tables[key]) - 1, 'plies')
+        if args.verify: verify(key, tables, args.verify, args.samples, random.Random(0))
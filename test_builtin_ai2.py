@@ -0,0 +1,19 @@
+from time import time
+from buildaboard import Range, PieceType, Piece, BitBoard, king
+import builtin_ai2
+
+# Reaches far to the south only: it is worth much more to the opponent, who
+# plays it flipped, than its price on the board says.
+southward = PieceType(Range(0, 0, 0, 0, 0, 7, 7, 7), Range(0, 0, 0, 0, 0, 0, 7, 0))
+stepper = PieceType(Range(1, 1, 1, 1, 1, 1, 1, 1), Range(1, 1, 1, 1, 1, 1, 1, 1))
+
+def test_asymmetric_capture_is_not_delta_pruned():
+    assert southward.price + builtin_ai2.DELTA < southward.flipped.price
+    board = BitBoard([Piece(king, 7, 7), Piece(southward, 4, 3)],
+                     [Piece(king, 0, 0), Piece(stepper, 3, 3)], True)
+    stand = -builtin_ai2.eval_b(board, not board.player_turn)
+    # Would be pruned if the victim were priced as it sits on the board.
+    alpha = stand + southward.price + builtin_ai2.DELTA
+    builtin_ai2.reset(time() + 60)
+    score = builtin_ai2.quiesce(board, alpha, builtin_ai2.INFINITY, 0)
+    assert score > alpha
@@ -0,0 +1,41 @@
+from random import Random
+from buildaboard import Piece, BitBoard, king, queen
+from engine import packMove, unpackMove
+import builtin_ai3
+
+def grown(board, iterations):
+    tree, rng = builtin_ai3.Tree(1 << 12), Random(0)
+    tree.expand(0, board, rng)
+    for _ in range(iterations): tree.iterate(board, rng)
+    return tree
+
+def terminals(tree, node):
+    return {tree.moves[child]: tree.terminal[child] for child in tree.children(node)}
+
+def test_compaction_keeps_terminal_nodes_terminal():
+    # The queen takes the king, after which black has lost.
+    board = BitBoard([Piece(king, 7, 7)], [Piece(king, 0, 0), Piece(queen, 3, 3)], True)
+    tree = grown(board, 300)
+    capture = packMove((board.squares[3 * 8 + 3], 7, 7))
+    before = terminals(tree, 0)
+    assert before[capture]
+    for budget in (tree.size, tree.count[0] + 1):
+        tree.compact(0, budget)
+        assert terminals(tree, 0) == before
+    visits = tree.visits[0]
+    for _ in range(10): tree.iterate(board, Random(1))
+    assert tree.visits[0] == visits + 10
+
+def test_reuse_finds_the_reply(monkeypatch):
+    monkeypatch.setattr(builtin_ai3, 'seed', 0)
+    monkeypatch.setattr(builtin_ai3, 'iterations', 500)
+    monkeypatch.setattr(builtin_ai3, 'tree', None)
+    board = BitBoard([Piece(king, 7, 4), Piece(queen, 6, 0)], [Piece(king, 0, 4), Piece(queen, 1, 7)], True)
+    builtin_ai3.choosemove(board)
+    tree = builtin_ai3.tree
+    reply = max(tree.children(tree.played), key=lambda node: tree.visits[node])
+    board = tree.board.copy(BitBoard)
+    board.make_move(unpackMove(board, tree.moves[reply]))
+    visits = tree.visits[reply]
+    builtin_ai3.choosemove(board)
+    assert visits and builtin_ai3.stats['reused'] == visits
@@ -0,0 +1,63 @@
+"""
+Plays many headless games between built-in engines across processes:
+
+    python3 tournament.py builtin_ai2 builtin_ai3 --games 100 --workers 8
+
+Every finished game is appended as one JSON line to the results file.
+With --metrics, every ply of every game is also logged as a JSON line,
+one file per game, and --profile adds a cProfile dump of each game.
+"""
+
+import json
+import os
+import random
+from argparse import ArgumentParser
+from importlib import import_module
+from multiprocessing import Pool
+from game import play
+from metrics import Metrics
+
+def run_game(task):
+    index, white, black, total_time, increment, seed, records, metrics, profile = task
+    random.seed(seed)
+    record = os.path.join(records, f'game-{index}.bab') if records else None
+    if metrics: metrics = Metrics(os.path.join(metrics, f'game-{index}.jsonl'), profile, game=index)
+    game = play(import_module(white), import_module(black), total_time, increment,
+                record=record, metrics=metrics)
+    return {'game': index, 'white': white, 'black': black,
+            'winner': {True: 'white', False: 'black', None: None}[game.winner],
+            'reason': game.result, 'plys': game.clock.plys,
+            'white_time': round(game.white_used, 3), 'black_time': round(game.black_used, 3)}
+
+def tournament(engines, games, workers, output, total_time=60, increment=1, seed=0, records=None,
+               metrics=None, profile=False):
+    # Every engine plays every other one, with colours alternating. Games
+    # are also recorded move by move in the records directory, and their
+    # metrics logged in the metrics directory, if given.
+    pairings = [(a, b) for a in engines for b in engines if a != b] or [(engines[0], engines[0])]
+    for directory in (records, metrics):
+        if directory: os.makedirs(directory, exist_ok=True)
+    tasks = [(i, *pairings[i % len(pairings)], total_time, increment, seed + i, records, metrics, profile)
+             for i in range(games)]
+    with Pool(workers) as pool, open(output, 'a') as results:
+        for result in pool.imap_unordered(run_game, tasks):
+            results.write(json.dumps(result, separators=(',', ':')) + '\n')
+            results.flush()
+            yield result
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Plays headless games between built-in engines.')
+    parser.add_argument('engines', nargs='+', help='engine modules, e.g. builtin_ai2')
+    parser.add_argument('--games', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--time', type=int, default=60, help='seconds per player')
+    parser.add_argument('--increment', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='results.jsonl')
+    parser.add_argument('--records', help='directory to record every game in')
+    parser.add_argument('--metrics', help='directory to log the metrics of every ply in')
+    parser.add_argument('--profile', action='store_true', help='profile every game, with --metrics')
+    args = parser.parse_args()
+    for result in tournament(args.engines, args.games, args.workers, args.output, args.time,
+                             args.increment, args.seed, args.records, args.metrics, args.profile):
+        print(result['game'], result['white'], 'vs', result['black'], '-', result['reason'])
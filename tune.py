@@ -0,0 +1,119 @@
+"""
+Fits the weights of the evaluation to positions written by selfplay.py:
+
+    python3 tune.py positions --epochs 5
+
+The evaluation is linear in the features selfplay.py keeps, so a whole
+batch of positions is scored by one matrix product. Weights are fitted so
+that a sigmoid of the evaluation predicts how the game ended for the side
+to move, optionally blended with what the search thought of the position,
+reading one chunk at a time. They start from the current prices, and are
+printed in their place.
+"""
+
+import json
+from argparse import ArgumentParser
+from dataclasses import astuple
+import numpy as np
+from buildaboard import Range, attackPrices, movementPrices
+from selfplay import chunks, sideFeatures
+
+# The weights are those of the difference between the side to move and the
+# other side in pieces, attack and movement ranges and ranks, then those of
+# the ranks of the two kings, which evaluate does not count the same way.
+# This is evaluate up to a constant: the king value only matters once a
+# king is gone, which never happens to a position that is played on.
+names = ['base'] + [f'attack.{f}' for f in Range.__dataclass_fields__] + \
+    [f'movement.{f}' for f in Range.__dataclass_fields__] + ['rank', 'king_rank', 'other_king_rank']
+
+def initialWeights():
+    return np.array([10, *astuple(attackPrices), *astuple(movementPrices), 1, -1, -1], dtype=np.float64)
+
+def design(features):
+    features = features.astype(np.float64)
+    own, other = features[:, :sideFeatures], features[:, sideFeatures:]
+    return np.hstack([own[:, :18] - other[:, :18], own[:, 19:20], other[:, 19:20]])
+
+def targets(chunk, blend, scale):
+    # How the game went for the side to move, from 0 to 1, mixed with the
+    # search score, from 0 at -scale or less to 1 at scale or more.
+    outcome = (chunk['result'] + 1) / 2
+    if not blend: return outcome
+    score = np.clip(chunk['score'], -scale, scale) / scale
+    return (1 - blend) * outcome + blend * (score + 1) / 2
+
+def sigmoid(x): return 1 / (1 + np.exp(-x))
+
+def batches(directory, size, blend, clip, rng):
+    # Mini-batches in random order within each chunk, so that only one
+    # chunk is in memory at a time.
+    for chunk in chunks(directory):
+        x, y = design(chunk['features']), targets(chunk, blend, clip)
+        order = rng.permutation(len(y))
+        for start in range(0, len(y), size):
+            batch = order[start:start + size]
+            yield x[batch], y[batch]
+
+def loss(directory, weights, k, blend, clip):
+    total = count = 0
+    for chunk in chunks(directory):
+        x, y = design(chunk['features']), targets(chunk, blend, clip)
+        total += np.sum((sigmoid(k * (x @ weights)) - y) ** 2)
+        count += len(y)
+    return total / max(count, 1)
+
+def fitScale(directory, weights, blend, clip):
+    # The k that fits the starting weights best, searched on a log scale;
+    # it turns evaluation units into odds and stays fixed afterwards.
+    low, high = np.log(1e-4), np.log(1)
+    for _ in range(30):
+        a, b = low + (high - low) / 3, high - (high - low) / 3
+        if loss(directory, weights, np.exp(a), blend, clip) < loss(directory, weights, np.exp(b), blend, clip):
+            high = b
+        else: low = a
+    return np.exp((low + high) / 2)
+
+def tune(directory, epochs=5, batch_size=4096, rate=.05, blend=0., clip=1000, seed=0):
+    # Adam on the mean squared error, yielding the starting weights, then
+    # the weights after every epoch.
+    rng = np.random.default_rng(seed)
+    weights = initialWeights()
+    k = fitScale(directory, weights, blend, clip)
+    yield {'epoch': 0, 'k': k, 'loss': loss(directory, weights, k, blend, clip), 'weights': weights.copy()}
+    m, v = np.zeros_like(weights), np.zeros_like(weights)
+    step = 0
+    for epoch in range(1, epochs + 1):
+        for x, y in batches(directory, batch_size, blend, clip, rng):
+            p = sigmoid(k * (x @ weights))
+            gradient = x.T @ ((p - y) * p * (1 - p)) * 2 * k / len(y)
+            step += 1
+            m = .9 * m + .1 * gradient
+            v = .999 * v + .001 * gradient ** 2
+            weights -= rate * (m / (1 - .9 ** step)) / (np.sqrt(v / (1 - .999 ** step)) + 1e-8)
+        yield {'epoch': epoch, 'k': k, 'loss': loss(directory, weights, k, blend, clip), 'weights': weights.copy()}
+
+def pricesCode(weights) -> str:
+    # Prices are scaled so that a piece still costs 10 on top of its ranges.
+    scaled = weights * 10 / weights[0]
+    rounded = lambda values: ', '.join(str(round(value)) for value in values)
+    return '\n'.join([f'movementPrices = Range({rounded(scaled[9:17])})',
+                      f'attackPrices = Range({rounded(scaled[1:9])})',
+                      f"# rank {scaled[17]:.2f}, king rank {scaled[18]:.2f}, other king rank {scaled[19]:.2f}"])
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Fits evaluation weights to self-play positions.')
+    parser.add_argument('directory')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch', type=int, default=4096)
+    parser.add_argument('--rate', type=float, default=.05)
+    parser.add_argument('--blend', type=float, default=0, help='weight of the search score in the targets')
+    parser.add_argument('--clip', type=float, default=1000, help='search score taken as a sure win')
+    parser.add_argument('--output', help='JSON file to write the weights to')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for report in tune(args.directory, args.epochs, args.batch, args.rate, args.blend, args.clip, args.seed):
+        print(f"epoch {report['epoch']}: loss {report['loss']:.5f}, k {report['k']:.5f}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(dict(zip(names, report['weights'].tolist()), k=report['k']), file, indent=1)
+    print(pricesCode(report['weights']))